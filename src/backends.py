@@ -0,0 +1,176 @@
+import json
+from abc import ABC, abstractmethod
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class BackendError(Exception):
+    """
+    A transient backend failure (timeout, dropped connection, server error) that is worth retrying.
+    """
+    pass
+
+
+class RateLimitedError(BackendError):
+    """
+    The backend asked us to slow down.
+    """
+    pass
+
+
+# map from backend name to the CompletionBackend class that implements it
+BACKENDS = {}
+
+
+def register_backend(name):
+    """
+    Class decorator adding a CompletionBackend to the registry under the given name.
+    """
+    def decorator(cls):
+        BACKENDS[name] = cls
+        cls.name = name
+        return cls
+    return decorator
+
+
+def get_backend(name, **kwargs):
+    """
+    Construct the backend registered under name.
+
+    :param kwargs: passed on to the backend's constructor
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"No backend named {name}, must be one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name](**kwargs)
+
+
+class CompletionBackend(ABC):
+    name = None
+
+    def __str__(self):
+        return f'<{self.__class__.__name__} {self.name}>'
+
+    @abstractmethod
+    def complete(self, model, prompt, **params):
+        """
+        Request a completion.
+
+        :param model: the model id to sample from
+        :param params: sampling parameters (temperature, max_tokens, stop...) in the OpenAI format
+        :return: a response in the OpenAI completion format, ie {'choices': [{'text': ..., 'index': 0}, ...]}
+        :raises BackendError: for failures worth retrying
+        """
+        pass
+
+    def stream(self, model, prompt, **params):
+        """
+        Request a completion, yielding its text in chunks as they are generated.
+        Backends that can't stream yield the whole completion as one chunk.
+        """
+        yield self.complete(model, prompt, **params)['choices'][0]['text']
+
+
+@register_backend('openai')
+class OpenAIBackend(CompletionBackend):
+    # openai errors worth trying again. Anything else (a bad request, a bad key...) will fail the same way next time.
+    RETRYABLE_ERRORS = (
+        openai.error.APIError,
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.TryAgain,
+    )
+
+    def __init__(self, request_timeout=None):
+        """
+        The hosted OpenAI API, through the openai library.
+
+        :param request_timeout: seconds to wait for a response before giving up (and retrying)
+        """
+        self.request_timeout = request_timeout
+
+    def complete(self, model, prompt, **params):
+        if self.request_timeout:
+            params['request_timeout'] = self.request_timeout
+        try:
+            return openai.Completion.create(model=model, prompt=prompt, **params)
+        except openai.error.RateLimitError as e:
+            raise RateLimitedError(str(e)) from e
+        except OpenAIBackend.RETRYABLE_ERRORS as e:
+            raise BackendError(str(e)) from e
+
+    def stream(self, model, prompt, **params):
+        if self.request_timeout:
+            params['request_timeout'] = self.request_timeout
+        try:
+            for event in openai.Completion.create(model=model, prompt=prompt, stream=True, **params):
+                yield event['choices'][0]['text']
+        except openai.error.RateLimitError as e:
+            raise RateLimitedError(str(e)) from e
+        except OpenAIBackend.RETRYABLE_ERRORS as e:
+            raise BackendError(str(e)) from e
+
+
+@register_backend('http')
+class HTTPBackend(CompletionBackend):
+    def __init__(self, base_url='http://localhost:8000/v1', api_key=None, connect_timeout=5., read_timeout=120.,
+                 pool_size=16):
+        """
+        Any OpenAI compatible completion endpoint (for example `python src/local_server.py`), over a persistent pool
+        of keep-alive connections.
+
+        :param base_url: the url that /completions is appended to
+        :param api_key: sent as a bearer token if given
+        :param connect_timeout: seconds to wait for a connection
+        :param read_timeout: seconds to wait for the completion once connected
+        :param pool_size: how many connections to keep open, should be at least the number of concurrent requests
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if api_key:
+            self.session.headers['Authorization'] = f'Bearer {api_key}'
+
+    def __str__(self):
+        return f'<HTTPBackend {self.base_url}>'
+
+    def _post(self, body, stream=False):
+        try:
+            response = self.session.post(f'{self.base_url}/completions', json=body, timeout=self.timeout, stream=stream)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise BackendError(str(e)) from e
+
+        if response.status_code == 429:
+            raise RateLimitedError(response.text)
+        if response.status_code >= 500:
+            raise BackendError(f'{response.status_code} {response.text}')
+        response.raise_for_status()
+        return response
+
+    def complete(self, model, prompt, **params):
+        return self._post({'model': model, 'prompt': prompt, **params}).json()
+
+    def stream(self, model, prompt, **params):
+        """
+        Read the server sent events of a streamed completion, one `data: {json}` line per chunk and `data: [DONE]` last.
+        """
+        response = self._post({'model': model, 'prompt': prompt, 'stream': True, **params}, stream=True)
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                yield json.loads(data)['choices'][0]['text']
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise BackendError(str(e)) from e
+        finally:
+            response.close()
+
+    def close(self):
+        self.session.close()
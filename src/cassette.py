@@ -0,0 +1,133 @@
+"""
+Record every completion of a session to a cassette file, then replay it with no network, eg to benchmark and profile
+the whole spindle pipeline reproducibly offline.
+
+    SPINDLE_RECORD=session.jsonl python src/spindle.py
+    SPINDLE_REPLAY=session.jsonl python src/spindle.py
+"""
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from backends import CompletionBackend, register_backend, get_backend
+from disk_cache import hash_key
+
+
+class CassetteMissError(LookupError):
+    """
+    Raised when replaying a request that was never recorded.
+    """
+    pass
+
+
+def request_key(model, prompt, params):
+    return hash_key(model, prompt, {k: v for k, v in params.items() if k != 'request_timeout'})
+
+
+@register_backend('record')
+class RecordingBackend(CompletionBackend):
+    def __init__(self, path, backend='openai'):
+        """
+        Pass requests on to another backend, appending each request, its response and how long it took to a cassette,
+        one json object per line.
+
+        :param path: the cassette file, appended to if it exists
+        :param backend: the CompletionBackend (or name of one) to record
+        """
+        self.path = path
+        self.backend = backend if isinstance(backend, CompletionBackend) else get_backend(backend)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'<RecordingBackend {self.backend} to {self.path}>'
+
+    def complete(self, model, prompt, **params):
+        start = time.perf_counter()
+        response = self.backend.complete(model, prompt, **params)
+        self._record(model, prompt, params, response, time.perf_counter() - start)
+        return response
+
+    def stream(self, model, prompt, **params):
+        """
+        Streams the consumer stops reading early (eg a discarded speculation or a losing hedge) are recorded too, as far
+        as they got, and marked partial.
+        """
+        start = time.perf_counter()
+        chunks = []
+        partial = True
+        try:
+            for chunk in self.backend.stream(model, prompt, **params):
+                chunks.append(chunk)
+                yield chunk
+            partial = False
+        except Exception:
+            chunks = None  # the backend failed, so there is nothing to replay
+            raise
+        finally:
+            if chunks is not None:
+                response = {'choices': [{'text': ''.join(chunks), 'index': 0}]}
+                self._record(model, prompt, params, response, time.perf_counter() - start, chunks=chunks,
+                             partial=partial)
+
+    def _record(self, model, prompt, params, response, latency, chunks=None, partial=False):
+        entry = {
+            'model': model,
+            'prompt': prompt,
+            'params': params,
+            'response': response,
+            'latency': latency,
+        }
+        if chunks is not None:
+            entry['chunks'] = chunks
+        if partial:
+            entry['partial'] = True
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+@register_backend('replay')
+class ReplayBackend(CompletionBackend):
+    def __init__(self, path, replay_latency=False):
+        """
+        Serve the responses recorded in a cassette. Requests recorded more than once (eg regenerating a title) are
+        answered in the order they were recorded, the last recorded response is repeated after that.
+        Partial streams (see RecordingBackend.stream) are replayed as far as they were recorded.
+
+        :param path: the cassette file
+        :param replay_latency: sleep for as long as each request originally took
+        """
+        self.path = path
+        self.replay_latency = replay_latency
+        self._entries = defaultdict(deque)
+        self._lock = threading.Lock()
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries[request_key(entry['model'], entry['prompt'], entry['params'])].append(entry)
+
+    def __str__(self):
+        return f'<ReplayBackend {self.path}>'
+
+    def _next_entry(self, model, prompt, params):
+        key = request_key(model, prompt, params)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise CassetteMissError(f'No recorded completion for {model} with prompt {prompt!r}')
+            return entries.popleft() if len(entries) > 1 else entries[0]
+
+    def complete(self, model, prompt, **params):
+        entry = self._next_entry(model, prompt, params)
+        if self.replay_latency:
+            time.sleep(entry['latency'])
+        return entry['response']
+
+    def stream(self, model, prompt, **params):
+        entry = self._next_entry(model, prompt, params)
+        chunks = entry.get('chunks') or [entry['response']['choices'][0]['text']]
+        for chunk in chunks:
+            if self.replay_latency:
+                time.sleep(entry['latency'] / len(chunks))
+            yield chunk
@@ -2,29 +2,52 @@ from collections import defaultdict
 from anytree import RenderTree, NodeMixin, PreOrderIter
 from anytree.exporter import DotExporter
 from twee_utils import *
-from narrative_reader import BasicVersionedReader, predicates_author
+from narrative_reader import BasicVersionedReader, predicates_author, embed, NLP_BATCH_SIZE
+from passage_index import PassageIndex
+
+
+# How a node's context is built from its ancestors (see PassageTree.construct_context)
+#   path: the narrative elements of every passage from the root to the node. Grows with the depth of the story.
+#   summary: a rolling summary of the story so far plus the parent's narrative elements. Stays the same size.
+#   retrieval: the narrative elements of the passages anywhere in the story most relevant to the node's title,
+#       then the parent's. Stays the same size, and picks up relevant side branches.
+CONTEXT_MODES = ('path', 'summary', 'retrieval')
 
 
 class PassageTree(NodeMixin):
     # Static reader version
     reader = None
-    def __init__(self, passage, title=None, parent=None, raw_passage=None, compute_context=True):
+    # Static context mode, one of CONTEXT_MODES
+    context_mode = 'path'
+    # Static function story -> summary used in the summary context mode, defaults to TwineGenerator.summarize_story
+    summarizer = None
+    # Static number of passages the retrieval context mode draws on, including the parent
+    retrieved_passages = 4
+
+    def __init__(self, passage, title=None, parent=None, raw_passage=None, compute_context=True,
+                 narrative_elements=None):
         """
         A contextualized node in a Twine tree, ie, a single passage.
         :param compute_context: whether or not to add context to the contextual nodes (can be slow)
+        :param narrative_elements: the passage's narrative elements, if they have already been extracted
+            (see PassageTree.create)
 
         AnyTree Docs: https://anytree.readthedocs.io/en/2.8.0/
         """
         self.lines = split_lines(passage)
         self.passage = passage
-        self.cleaned_passage_text = passage_to_text('\n'.join(self.lines[1:])) if not raw_passage else passage_to_text('\n'.join(raw_passage.split('\n')[1:]))
+        self.cleaned_passage_text = PassageTree.clean_text(passage, raw_passage)
         self.title = title if title else get_title(self.lines)
         self.name = self.title
         self.parent = parent
         self._links = None
-        self.narrative_elements = self._extract_narrative_elements()
+        self.rolling_summary = None
+        self.passage_index = None  # only kept on the root, see get_index
+        self.narrative_elements = narrative_elements if narrative_elements is not None else self._extract_narrative_elements()
         # the context is all relevant story details along the path from the root to the current node
-        self.full_context = self.construct_context(parent) if (parent and compute_context) else []
+        self.full_context = self.construct_context(parent, title=self.title) if (parent and compute_context) else []
+        if PassageTree.context_mode == 'retrieval':
+            self.get_index().add(self, embed(self.cleaned_passage_text))
         self.context_text = PassageTree.get_reader().write_context_text(self.full_context)
 
     def __str__(self):
@@ -56,21 +79,71 @@ class PassageTree(NodeMixin):
 
     def convert_events_to_fake_token(self):
         """
-        spacy doesn't support the pickling of individual tokens
-        this was my attempt to work around that
+        Deprecated, does nothing. Events used to be spaCy tokens, which can't be pickled, and this converted them.
+        They are now extracted as EventToken records (see narrative_reader.make_event), which can.
+
+        :return: the events of this passage, unchanged
         """
-        for n in PreOrderIter(self):
-            new_events = []
-            for triple in n.narrative_elements['events']:
-                fake_triple = []
-                for component in triple:
-                    fake_triple.append([BespokeToken(token) for token in component])
-                new_events.append(fake_triple)
+        return self.narrative_elements.get('events')
 
-            n.narrative_elements['events'] = new_events
+    def add_summaries(self, generator, **kwargs):
+        """
+        Summarize every passage in this (sub)tree with generator.summarize_many and add the summaries to each node's
+        narrative elements, where they become the `summary` context component of its descendants.
 
-        for n in PreOrderIter(self):
-            print(n.narrative_elements['events'])
+        :param generator: an external_model.TwineGenerator
+        :param kwargs: passed on to summarize_many
+        """
+        nodes = list(PreOrderIter(self))
+        summaries = generator.summarize_many([n.cleaned_passage_text for n in nodes], clean_passage=False, **kwargs)
+        for n, summary in zip(nodes, summaries):
+            n.narrative_elements['summary'] = summary
+        for n in nodes:
+            n.context_text = PassageTree.get_reader().write_context_text(n.full_context)
+
+    def get_rolling_summary(self):
+        """
+        Return a summary of the story from the root down to this passage, made by summarizing the parent's rolling
+        summary followed by this passage. It is computed the first time it's needed, then kept on the node.
+        """
+        missing = []
+        node = self
+        while node is not None and node.rolling_summary is None:
+            missing.append(node)
+            node = node.parent
+        # Summarize from the top down, each summary builds on the one above it
+        for node in reversed(missing):
+            previous = node.parent.rolling_summary if node.parent else ''
+            node.rolling_summary = PassageTree.get_summarizer()(f'{previous} {node.cleaned_passage_text}'.strip())
+        return self.rolling_summary
+
+    def get_index(self):
+        """
+        Return the index of the vectors of every passage in the tree, which is kept on the root.
+        """
+        root = self.root
+        if root.passage_index is None:
+            root.passage_index = PassageIndex()
+        return root.passage_index
+
+    @staticmethod
+    def clean_text(passage, raw_passage=None):
+        """
+        The text of a passage (or of its raw version, if given) without its title and twee formatting.
+        """
+        if raw_passage:
+            return passage_to_text('\n'.join(raw_passage.split('\n')[1:]))
+        return passage_to_text('\n'.join(split_lines(passage)[1:]))
+
+    @staticmethod
+    def get_summarizer():
+        """
+        Return the singleton summarizer, or a quiet TwineGenerator's summarize_story if none has been set.
+        """
+        if PassageTree.summarizer is None:
+            from external_model import TwineGenerator  # only needed for summary context
+            PassageTree.summarizer = TwineGenerator('naive', verbose=False).summarize_story
+        return PassageTree.summarizer
 
     @staticmethod
     def get_reader(version=1.3):
@@ -85,25 +158,43 @@ class PassageTree(NodeMixin):
         return PassageTree.reader
 
     @staticmethod
-    def construct_context(parent):
+    def construct_context(parent, title=None):
         """
         Returns a list of context components / narrative elements.
         Each are dictionaries of the form:
             {narrative element type: value ...}
+
+        What the list covers depends on PassageTree.context_mode, see CONTEXT_MODES.
+
+        :param title: the title of the passage the context is for, used to find relevant passages
         """
         if parent is None:
             return []
 
-        return parent.full_context + [parent.narrative_elements]
+        if PassageTree.context_mode == 'path':
+            return parent.full_context + [parent.narrative_elements]
+        if PassageTree.context_mode == 'summary':
+            return [dict(parent.narrative_elements, summary=parent.get_rolling_summary())]
+        if PassageTree.context_mode == 'retrieval':
+            query = title.lstrip(':').strip() if title else ''
+            related = parent.get_index().search(
+                embed(query), PassageTree.retrieved_passages - 1, exclude=[parent], in_order=True
+            ) if query else []
+            return [node.narrative_elements for node, _ in related] + [parent.narrative_elements]
+        raise ValueError(f"No context mode {PassageTree.context_mode}, must be one of: {', '.join(CONTEXT_MODES)}")
 
     @staticmethod
-    def create(twee=None, passages=None):
+    def create(twee=None, passages=None, batch_size=NLP_BATCH_SIZE):
         """
         Create a contextual tree from some twee passages.
 
+        Every reachable passage is collected first, so that their narrative elements can be extracted in batches,
+        which is much faster than one passage at a time.
+
         You must specify one of:
             :param twee: the full document
             :param passages: the split passages
+        :param batch_size: how many passages the NLP models process at once
         """
         if bool(twee) == bool(passages):
             raise SyntaxError("should call with either twee or passages defined")
@@ -116,46 +207,42 @@ class PassageTree(NodeMixin):
         # Make a dictionary mapping title_text: full_passage
         passage_dict = make_passage_dict(passages)
 
-        # Create a contextual tree
-        root = PassageTree(start)
-        PassageTree._traverse_and_create_context(root, passage_dict, defaultdict(bool))
-        return root, passage_dict
+        # Plan the tree, extract from every passage in it at once, then create it
+        plan = [(start, None, None)]
+        PassageTree._collect_passages(0, start, passage_dict, defaultdict(bool), plan)
+        elements = PassageTree.get_reader().make_many_context_components(
+            [PassageTree.clean_text(passage) for passage, _, _ in plan], batch_size=batch_size
+        )
+        nodes = []
+        for (passage, title, parent), narrative_elements in zip(plan, elements):
+            parent = nodes[parent] if parent is not None else None
+            nodes.append(PassageTree(passage, title=title, parent=parent, narrative_elements=narrative_elements))
+        return nodes[0], passage_dict
 
     @staticmethod
-    def _traverse_and_create_context(node, passage_dict, visited):
+    def _collect_passages(i, passage, passage_dict, visited, plan):
         """
         Helper method for tree creation.
-        Add children to a twee tree by recursively iterating over the links in each twee passage,
-        keeping track of the context you've seen before.
-        :param node: the current root node to expand
+        Plan the children of a passage by recursively iterating over the links in each twee passage,
+        keeping track of the passages you've seen before.
+        :param i: the index in the plan of the passage to expand
         :param passage_dict: a mapping from link (title text) to passage
         :param visited: a dict mapping link -> a bool of whether its been visited. should have been a set of
+        :param plan: a list of (passage, title, index of the parent in the plan), in the order the nodes are created
+            in, parents first. Children are appended to it.
         """
-        for link in node.get_links():
+        for link in get_links(passage):
             if visited[link]:
                 continue
-            passage = passage_dict.get(link)
-            if passage:
-                # create the child and add it to the parent
-                child_node = PassageTree(passage, title=make_title(link), parent=node)
+            child = passage_dict.get(link)
+            if child:
+                plan.append((child, make_title(link), i))
                 visited[link] = True
-                PassageTree._traverse_and_create_context(child_node, passage_dict, visited)
+                PassageTree._collect_passages(len(plan) - 1, child, passage_dict, visited, plan)
             else:
                 print(f"passage {link} does not exist")
 
 
-class BespokeToken:
-    def __init__(self, token):
-        self.text = token.text
-        self.lemma_ = token.lemma_
-
-    def __repr__(self):
-        return f"~{self.text}"
-
-    def __str__(self):
-        return str(self.text)
-
-
 if __name__ == '__main__':
     # TODO need to check whether 'name [1]' should link to 'name' or not
     game = './generated_games/context_1.tw'
@@ -165,7 +252,6 @@ if __name__ == '__main__':
         print(f'tree for {game}:')
         PassageTree.reader = BasicVersionedReader(1.3)
         tree, _ = PassageTree.create(twee=twee_str)
-        tree.convert_events_to_fake_token()
         for n in PreOrderIter(tree):
             print(n, predicates_author(n.narrative_elements['events']))
 
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def hash_key(*parts):
+    """
+    Hash some json serializable parts (prompts, model names, parameter dicts...) into a stable hex key.
+    """
+    blob = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    def __init__(self, path, max_entries=10000, max_bytes=None):
+        """
+        A persistent key -> value store backed by sqlite, with least recently used eviction.
+        Values can be anything json serializable. Safe to share between threads.
+
+        The number of entries and bytes stored are counted when the cache is opened and kept up to date as it is
+        written, so writes don't slow down as the cache grows. Reads don't write: the entries they use are marked as
+        recently used with the next write.
+
+        :param path: the sqlite file to keep the cache in (its directory is created if needed), or ':memory:'
+        :param max_entries: evict the least recently used entries once there are more than this many
+        :param max_bytes: evict the least recently used entries once the stored values take more than this many bytes
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> when it was last read, not yet written to the table
+        self._used = {}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, used REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+        self._db.commit()
+        self._count, self._size = self._db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM cache'
+        ).fetchone()
+
+    def __str__(self):
+        return f'<DiskCache {self.path} {len(self)} entries>'
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM cache WHERE key = ?', (key,)).fetchone() is not None
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for key (marking it as recently used), or default if it isn't cached.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._used[key] = time.time()
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        """
+        Set many (key, value) pairs in one transaction, which is much faster than setting them one at a time.
+        """
+        rows = [(key, json.dumps(value)) for key, value in items]
+        with self._lock:
+            self._write_used()
+            now = time.time()
+            for key, value in rows:
+                self._remove(key)
+                self._db.execute('INSERT INTO cache (key, value, used) VALUES (?, ?, ?)', (key, value, now))
+                self._count += 1
+                self._size += len(value)
+            self._evict()
+            self._db.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM cache')
+            self._db.commit()
+            self._used.clear()
+            self._count = self._size = 0
+            self.hits = self.misses = 0
+
+    def evict(self):
+        """
+        Drop the least recently used entries until the cache is within its size limits.
+        """
+        with self._lock:
+            self._write_used()
+            self._evict()
+            self._db.commit()
+
+    def _remove(self, key):
+        row = self._db.execute('SELECT LENGTH(value) FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._count -= 1
+            self._size -= row[0]
+        self._used.pop(key, None)
+
+    def _write_used(self):
+        if self._used:
+            self._db.executemany('UPDATE cache SET used = ? WHERE key = ?', [(t, k) for k, t in self._used.items()])
+            self._used.clear()
+
+    def _evict(self):
+        evicted = 0
+        if self.max_entries is not None and self._count > self.max_entries:
+            evicted = self._count - self.max_entries
+        if self.max_bytes is not None and self._size > self.max_bytes:
+            # Walk the entries from the least recently used until enough bytes would be freed
+            excess, freed, entries = self._size - self.max_bytes, 0, 0
+            for length, in self._db.execute('SELECT LENGTH(value) FROM cache ORDER BY used, rowid'):
+                if freed >= excess:
+                    break
+                freed += length
+                entries += 1
+            evicted = max(evicted, entries)
+        if not evicted:
+            return
+        oldest = 'SELECT key FROM cache ORDER BY used, rowid LIMIT ?'
+        count, size = self._db.execute(
+            f'SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM cache WHERE key IN ({oldest})', (evicted,)
+        ).fetchone()
+        self._db.execute(f'DELETE FROM cache WHERE key IN ({oldest})', (evicted,))
+        self._count -= count
+        self._size -= size
+
+    def stats(self):
+        """
+        :return: a dict of hits, misses, hit rate and the number of stored entries
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.,
+            'entries': len(self),
+        }
+
+    def close(self):
+        with self._lock:
+            self._write_used()
+            self._db.commit()
+            self._db.close()
@@ -1,19 +1,149 @@
 import openai
 import os
+import json
 import time
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import twee_utils as utils
+from disk_cache import DiskCache, hash_key
+from rate_limit import TokenBucket, RetryBudget, CircuitBreaker, CircuitOpenError, backoff_delay
+from backends import CompletionBackend, BackendError, RateLimitedError, get_backend
+from cassette import RecordingBackend, ReplayBackend
+from simulation import SimulatedBackend
+from telemetry import Telemetry
+from hedging import Hedger
+from token_budget import count_tokens
 
 # Load your API key from an environment variable or secret management service
 openai.api_key = os.getenv("OPENAI_API_KEY")
-ZERO_SHOT = open('src/zero_shot.txt', 'r').read()
+# The zero shot summarization prompt, read on first use (see get_zero_shot)
+ZERO_SHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zero_shot.txt')
+ZERO_SHOT = None
+# The zero shot prompt for summarizing a whole story so far in a few sentences (see get_story_zero_shot)
+STORY_ZERO_SHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'story_zero_shot.txt')
+STORY_ZERO_SHOT = None
+
+# Where completions are cached between sessions
+CACHE_DIR = 'spindle_cache'
+COMPLETION_CACHE_PATH = os.path.join(CACHE_DIR, 'completions.sqlite3')
+MAX_CACHED_COMPLETIONS = 20000
+SUMMARY_CACHE_PATH = os.path.join(CACHE_DIR, 'summaries.sqlite3')
+MAX_CACHED_SUMMARIES = 100000
+# How many summaries summarize_many requests at once
+SUMMARY_CONCURRENCY = 4
+
+# Client side limits shared by every generator and thread
+MAX_REQUESTS_PER_SECOND = 2
+MAX_RETRIES = 6
+RETRY_BASE_DELAY = 1  # seconds, doubled on each retry
+RETRY_MAX_DELAY = 60
+FAILURES_BEFORE_CIRCUIT_OPENS = 5
+CIRCUIT_RESET_TIMEOUT = 30  # seconds
+
+# Hedged generators send a duplicate request when one is slower than this percentile of recent requests
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20  # requests to observe before hedging any
+
+# Which backend (see backends.BACKENDS) serves completions, and the options it is constructed with
+DEFAULT_BACKEND = os.getenv('SPINDLE_BACKEND', 'openai')
+BACKEND_OPTIONS = {
+    'openai': {},
+    'http': {
+        'base_url': os.getenv('SPINDLE_BASE_URL', 'http://localhost:8000/v1'),
+        'api_key': os.getenv('SPINDLE_API_KEY'),
+    },
+    # eg SPINDLE_SIMULATION='{"latency": "exponential", "rate_limit_rate": 0.1}', see simulation.SimulatedBackend
+    'simulate': json.loads(os.getenv('SPINDLE_SIMULATION', '{}')),
+}
+
+# Record every completion of the session to this cassette file, or replay one (see cassette.py)
+RECORD_CASSETTE = os.getenv('SPINDLE_RECORD')
+REPLAY_CASSETTE = os.getenv('SPINDLE_REPLAY')
+# Whether replayed completions take as long as they did when recorded
+REPLAY_LATENCY = bool(os.getenv('SPINDLE_REPLAY_LATENCY'))
+
+# The fine-tuned model behind each generator
+MODELS = {
+    'naive': 'curie:ft-user-wmco7qacght9seweh8jgp4ib-2021-10-28-04-55-18',
+    'context': 'curie:ft-user-wmco7qacght9seweh8jgp4ib-2021-11-29-05-45-10',
+    'events': 'curie:ft-user-wmco7qacght9seweh8jgp4ib-2021-12-07-08-07-09',
+}
+SUMMARY_MODEL = 'davinci'  # It doesn't really work with curie
+# The model id the mock generator asks its (simulated, by default) backend for
+MOCK_MODEL = 'mock'
+
+PASSAGE_PARAMS = {
+    'temperature': 0.7,
+    'max_tokens': 1000,
+    'top_p': 1,
+    'frequency_penalty': 0,
+    'presence_penalty': 0,
+    'stop': utils.END,
+}
+SUMMARY_PARAMS = {
+    'temperature': 0.7,
+    'max_tokens': 280,
+    'top_p': 1,
+    'frequency_penalty': 0,
+    'presence_penalty': 0,
+    'stop': '.',
+}
+# Story summaries run to several sentences, so they stop at the prompt's closing quotes rather than the first full stop
+STORY_SUMMARY_PARAMS = dict(SUMMARY_PARAMS, stop='"""')
+
+
+def get_zero_shot():
+    global ZERO_SHOT
+    if ZERO_SHOT is None:
+        with open(ZERO_SHOT_PATH, 'r') as f:
+            ZERO_SHOT = f.read()
+    return ZERO_SHOT
+
+
+def get_story_zero_shot():
+    global STORY_ZERO_SHOT
+    if STORY_ZERO_SHOT is None:
+        with open(STORY_ZERO_SHOT_PATH, 'r') as f:
+            STORY_ZERO_SHOT = f.read()
+    return STORY_ZERO_SHOT
+
 
 class TwineGenerator:
-    def __init__(self, model='context', verbose=True):
+    # Static completion and summary caches, shared by every generator
+    cache = None
+    summary_cache = None
+    # Shared by every generator, so concurrent generation is rate limited as a whole
+    rate_limiter = TokenBucket(MAX_REQUESTS_PER_SECOND)
+    retry_budget = RetryBudget()
+    circuit_breaker = CircuitBreaker(FAILURES_BEFORE_CIRCUIT_OPENS, CIRCUIT_RESET_TIMEOUT)
+    # Latency, tokens, retries, waits and cache status of every call, by every generator
+    telemetry = Telemetry()
+    # Latencies of completions, and of the first chunk of streams, that hedged generators hedge on
+    hedger = Hedger(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    stream_hedger = Hedger(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    # Static cassette path -> the ReplayBackend every generator replaying it shares, so that requests recorded more
+    # than once are answered in the order they were recorded whichever generator makes them
+    replay_backends = {}
+
+    def __init__(self, model='context', verbose=True, use_cache=True, backend=None, hedge=False,
+                 record=RECORD_CASSETTE, replay=REPLAY_CASSETTE, replay_latency=REPLAY_LATENCY):
         """
-        :param model: must be one of: 'context', 'mock', or 'naive'
+        :param model: must be one of: 'context', 'events', 'mock', or 'naive' (or another key added to MODELS)
             context: Call GPT-3 with a context description and passage title
+            events: Call GPT-3 with a context description including preceding events and passage title
             naive: Call GPT-3 with only a passage title
-            mock: Mock the language model call
+            mock: Simulate the language model (see simulation.py) unless another backend is given. Never cached.
+        :param use_cache: whether to serve repeated prompts from the completion cache. Pass False for fresh samples.
+            Methods take a use_cache argument too, to skip the cache for a single call.
+        :param backend: a CompletionBackend or the name of a registered one, defaults to DEFAULT_BACKEND
+        :param hedge: send a duplicate of passage requests that are slow (see HEDGE_PERCENTILE) and use whichever
+            answers first. This trades a few extra tokens for a shorter wait in the worst cases.
+        :param record: a cassette file to record every request and response to
+        :param replay: a cassette file to serve recorded responses from instead of calling the backend
+        :param replay_latency: whether replayed responses take as long as they did when they were recorded
+
+        The completion cache isn't used while recording or replaying, so that every call is recorded or replayed.
+        A backend that is already recording or replaying (eg another generator's) isn't wrapped again.
 
         Each will return a passage body that can be appended to the title to make a complete Twee passage.
         """
@@ -21,140 +151,385 @@ class TwineGenerator:
         self.model = model.lower()
 
         self.verbose = bool(verbose)
-        if self.model == 'events':
-            self._call_model = TwineGenerator._call_contextual_event_model
-        elif self.model == 'context':
-            self._call_model = TwineGenerator._call_contextual_model
-        elif self.model == 'mock':
-            self._call_model = TwineGenerator._mock_generate
-        elif self.model == 'naive':
-            self._call_model = TwineGenerator._call_naive_model
+        self.use_cache = bool(use_cache) and self.model != 'mock'
+        self.hedge = bool(hedge)
+        if self.model == 'mock':
+            self.model_id = MOCK_MODEL
+            backend = backend if backend else 'simulate'
+        elif self.model in MODELS:
+            self.model_id = MODELS[self.model]
         else:
             raise ValueError(f"TwineGenerator({self.model}) is invalid")
+        self._call_model = self._call_language_model
 
-    def get_completion(self, prompt):
+        backend = backend if backend else DEFAULT_BACKEND
+        if not isinstance(backend, CompletionBackend):
+            backend = get_backend(backend, **BACKEND_OPTIONS.get(backend, {}))
+        if not isinstance(backend, (RecordingBackend, ReplayBackend)):
+            if replay:
+                if replay not in TwineGenerator.replay_backends:
+                    TwineGenerator.replay_backends[replay] = ReplayBackend(replay, replay_latency=replay_latency)
+                backend = TwineGenerator.replay_backends[replay]
+            elif record:
+                backend = RecordingBackend(record, backend)
+        if isinstance(backend, (RecordingBackend, ReplayBackend)):
+            self.use_cache = False
+        self.backend = backend
+
+    def get_completion(self, prompt, use_cache=None):
         """
         call the correct language model
+
+        :param use_cache: pass False to skip the cache for this call
         """
         if self.verbose:
             print("prompt", prompt)
 
-        while True:
+        use_cache = self._use_cache(use_cache)
+        return self._call_model(prompt, use_cache=use_cache)
+
+    def stream_completion(self, prompt, use_cache=None):
+        """
+        Like get_completion, but yield the completion in chunks as they are generated, so the caller can show the
+        passage (see twee_utils.PassageStream) before it is finished. The stream stops as soon as utils.END is seen.
+        Cached completions are yielded in one chunk.
+
+        :param use_cache: pass False to skip the cache for this call
+        """
+        if self.verbose:
+            print("prompt", prompt)
+
+        use_cache = self._use_cache(use_cache)
+        with TwineGenerator.telemetry.call('stream', self.model_id) as call:
+            cache = self._get_cache()
+            key = self._cache_key(self.model_id, prompt, PASSAGE_PARAMS)
+            text = cache.get(key) if use_cache else None
+            if text is not None:
+                self._record_tokens(call, prompt, text, cache='hit')
+                yield text
+                return
+
+            chunks = self._send(self.model_id, prompt, PASSAGE_PARAMS, stream=True, call=call)
+            text, sent = '', 0
             try:
-                return self._call_model(prompt)
-            except openai.error.RateLimitError as e:
-                print(e)
-                print('retrying...')
+                for chunk in chunks:
+                    text += chunk
+                    if utils.END in text:
+                        text = text[:text.index(utils.END)]
+                        break
+                    # Hold back anything that could be the start of a split END token
+                    safe = len(text) - len(utils.END) + 1
+                    if safe > sent:
+                        yield text[sent:safe]
+                        sent = safe
+            finally:
+                chunks.close()
+                # Streams don't report usage, so the tokens are counted (or estimated) locally
+                self._record_tokens(call, prompt, text, cache='miss' if use_cache else 'skip')
+            if len(text) > sent:
+                yield text[sent:]
+            if cache is not None:
+                cache.set(key, text)
 
-    def _call_model(self, prompt):
-        raise RuntimeError("This should have been defined in the constructor")
+    def get_candidates(self, prompt, k, use_cache=None):
+        """
+        Sample k completions of the prompt in one request (the n parameter), so the best can be picked locally
+        rather than asking again when one turns out to be unusable.
 
-    @staticmethod
-    def _call_naive_model(prompt):
+        :param use_cache: pass False to skip the cache for this call
+        :return: a list of k completions
         """
-        Return a generated twee passage from a given title. The code is elsewhere modular to allow this to be re-implemented
-        with any language model. Here, we call a fine-tuned GPT-3 instance trained to generate scaffolded Twee.
+        if self.verbose:
+            print("prompt", prompt)
+
+        use_cache = self._use_cache(use_cache)
+        params = dict(PASSAGE_PARAMS, n=k)
+        with TwineGenerator.telemetry.call('candidates', self.model_id) as call:
+            cache = self._get_cache()
+            key = self._cache_key(self.model_id, prompt, params)
+            candidates = cache.get(key) if use_cache else None
+            if candidates is not None:
+                self._record_tokens(call, prompt, candidates, cache='hit')
+                return candidates
+
+            response = self._request(self.model_id, prompt, params, call=call)
+            candidates = [choice['text'] for choice in sorted(response['choices'], key=lambda choice: choice['index'])]
+            self._record_tokens(call, prompt, candidates, response, cache='miss' if use_cache else 'skip')
+            if cache is not None:
+                cache.set(key, candidates)
+            return candidates
+
+    def get_completions(self, prompts, use_cache=None):
         """
+        Complete several prompts with one batched request (the completion endpoint takes a list of prompts),
+        which shares the request overhead and the rate limit between them. Prompts that are cached aren't sent, and
+        if the batch fails (or comes back without some choices) the missing prompts are completed one at a time.
 
-        model = 'curie:ft-user-wmco7qacght9seweh8jgp4ib-2021-10-28-04-55-18'
+        :param use_cache: pass False to skip the cache, for all the prompts or as a list with one setting per prompt
+        :return: a list of completions, in the same order as the prompts
+        """
+        if self.verbose:
+            for prompt in prompts:
+                print("prompt", prompt)
 
-        response = openai.Completion.create(
-            model=model,
-            prompt=prompt,
-            temperature=0.7,
-            max_tokens=1000,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=utils.END,
-        )
+        use_cache = use_cache if isinstance(use_cache, (list, tuple)) else [use_cache] * len(prompts)
+        use_cache = [self._use_cache(cached) for cached in use_cache]
+        cache = self._get_cache()
+        keys = [self._cache_key(self.model_id, prompt, PASSAGE_PARAMS) for prompt in prompts]
+        completions = [cache.get(key) if cached else None for key, cached in zip(keys, use_cache)]
+        missing = [i for i, completion in enumerate(completions) if completion is None]
 
-        return response['choices'][0]['text']
+        if len(missing) > 1:
+            try:
+                with TwineGenerator.telemetry.call('batch', self.model_id) as call:
+                    batch = [prompts[i] for i in missing]
+                    response = self._request(self.model_id, batch, PASSAGE_PARAMS, call=call)
+                    for choice in response['choices']:
+                        i = missing[choice['index']]
+                        completions[i] = choice['text']
+                        if cache is not None:
+                            cache.set(keys[i], choice['text'])
+                    self._record_tokens(call, batch, [completions[i] or '' for i in missing], response,
+                                        cache='miss' if any(use_cache) else 'skip')
+            except (BackendError, CircuitOpenError) as e:
+                print(f'Batch of {len(missing)} prompts failed ({e}), completing them one at a time.')
 
-    @staticmethod
-    def _call_contextual_model(prompt):
+        for i in missing:
+            if completions[i] is None:
+                completions[i] = self._complete(self.model_id, prompts[i], PASSAGE_PARAMS, use_cache=False)
+        return completions
+
+    def _use_cache(self, use_cache=None):
+        return self.use_cache if use_cache is None else (self.use_cache and use_cache)
+
+    def _call_model(self, prompt, use_cache=True):
+        raise RuntimeError("This should have been defined in the constructor")
+
+    def _call_language_model(self, prompt, use_cache=True):
         """
         Return a generated twee passage from a given title. The code is elsewhere modular to allow this to be re-implemented
         with any language model. Here, we call a fine-tuned GPT-3 instance trained to generate scaffolded Twee.
         """
+        return self._complete(self.model_id, prompt, PASSAGE_PARAMS, use_cache=use_cache)
 
-        model = 'curie:ft-user-wmco7qacght9seweh8jgp4ib-2021-11-29-05-45-10'
+    @staticmethod
+    def get_cache():
+        """
+        Return the singleton completion cache, opening it if it doesn't exist yet.
+        """
+        if TwineGenerator.cache is None:
+            TwineGenerator.cache = DiskCache(COMPLETION_CACHE_PATH, max_entries=MAX_CACHED_COMPLETIONS)
+        return TwineGenerator.cache
+
+    @staticmethod
+    def get_summary_cache():
+        """
+        Return the singleton summary cache, which maps the hash of a passage's cleaned text to its summary.
+        """
+        if TwineGenerator.summary_cache is None:
+            TwineGenerator.summary_cache = DiskCache(SUMMARY_CACHE_PATH, max_entries=MAX_CACHED_SUMMARIES)
+        return TwineGenerator.summary_cache
 
-        response = openai.Completion.create(
-            model=model,
-            prompt=prompt,
-            temperature=0.7,
-            max_tokens=1000,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=utils.END,
-        )
+    def _get_cache(self):
+        """
+        Return the completion cache, or None if this generator doesn't cache (eg mock, recording or replaying),
+        in which case nothing is read from or written to it.
+        """
+        return TwineGenerator.get_cache() if self.use_cache else None
+
+    def _cache_key(self, model, prompt, params):
+        return hash_key(prompt, model, params, str(self.backend))
+
+    def _complete(self, model, prompt, params, use_cache=True, kind='passage'):
+        """
+        Return the text of a single completion, keyed in the cache by the prompt, model, sampling parameters and backend.
+        Fresh completions are always written back to the cache, so the latest sample is the one served next time.
 
-        return response['choices'][0]['text']
+        :param kind: what the completion is for, the telemetry groups calls by it
+        """
+        with TwineGenerator.telemetry.call(kind, model) as call:
+            cache = self._get_cache()
+            key = self._cache_key(model, prompt, params)
+            if use_cache:
+                text = cache.get(key)
+                if text is not None:
+                    self._record_tokens(call, prompt, text, cache='hit')
+                    return text
 
+            if kind == 'passage':
+                response = self._send(model, prompt, params, call=call)
+            else:
+                response = self._request(model, prompt, params, call=call)
+            text = response['choices'][0]['text']
+            self._record_tokens(call, prompt, text, response, cache='miss' if use_cache else 'skip')
+            if cache is not None:
+                cache.set(key, text)
+            return text
 
     @staticmethod
-    def _call_contextual_event_model(prompt):
+    def _record_tokens(call, prompt, completion, response=None, cache='skip'):
         """
-        Return a generated twee passage from a given title. The code is elsewhere modular to allow this to be re-implemented
-        with any language model. Here, we call a fine-tuned GPT-3 instance trained to generate scaffolded Twee.
+        Fill in the cache status and token counts of a telemetry record, from the usage the backend reported if
+        it did, otherwise by counting them.
+
+        :param prompt: a prompt or list of prompts
+        :param completion: a completion or list of completions
         """
+        call['cache'] = cache
+        usage = response.get('usage') if isinstance(response, dict) else None
+        if usage:
+            call['prompt_tokens'] = usage.get('prompt_tokens', 0)
+            call['completion_tokens'] = usage.get('completion_tokens', 0)
+            return
+        prompts = prompt if isinstance(prompt, (list, tuple)) else [prompt]
+        completions = completion if isinstance(completion, (list, tuple)) else [completion]
+        call['prompt_tokens'] = sum(count_tokens(text) for text in prompts)
+        call['completion_tokens'] = sum(count_tokens(text) for text in completions)
 
+    def _open_stream(self, model, prompt, **params):
+        """
+        Start a streamed completion. Wait for the first chunk, so that failures to connect happen here (and can be
+        retried) rather than partway through the caller's loop.
+        """
+        chunks = self.backend.stream(model, prompt, **params)
+        first = next(chunks, '')
 
-        model = 'curie:ft-user-wmco7qacght9seweh8jgp4ib-2021-12-07-08-07-09'
+        def stream():
+            try:
+                yield from itertools.chain([first], chunks)
+            finally:
+                chunks.close()
 
-        response = openai.Completion.create(
-            model=model,
-            prompt=prompt,
-            temperature=0.7,
-            max_tokens=1000,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=utils.END,
-        )
+        return stream()
 
-        return response['choices'][0]['text']
+    def _send(self, model, prompt, params, stream=False, call=None):
+        """
+        Make a passage request (see _request), hedged if this generator hedges. Streams are hedged on how long the first
+        chunk takes, and the losing stream is closed.
+        Each attempt keeps its retries and waits in a telemetry record of its own, only the winner's end up in call.
+        """
+        if not self.hedge:
+            return self._request(model, prompt, params, stream=stream, call=call)
+        hedger = TwineGenerator.stream_hedger if stream else TwineGenerator.hedger
 
-    @staticmethod
-    def summarize(passage, clean_passage=True):
+        def attempt():
+            record = {}
+            return record, self._request(model, prompt, params, stream=stream, call=record)
+
+        discard = (lambda result: result[1].close()) if stream else None
+        record, response = hedger.call(attempt, discard=discard)
+        if call is not None:
+            call.update(record)
+        return response
+
+    def _request(self, model, prompt, params, stream=False, call=None):
+        """
+        Call the backend's completion endpoint through the shared rate limiter.
+        Transient errors are retried with jittered exponential backoff, up to MAX_RETRIES times and as long as the
+        shared retry budget allows. Once the backend has failed too often in a row, calls fail fast with
+        CircuitOpenError until it has had time to recover. Rate limits don't count as failures, they slow the rate
+        limiter down instead.
+
+        :param stream: return a generator of text chunks (see backends.CompletionBackend.stream) instead of a response
+        :param call: a telemetry record (see Telemetry.call) to add the retries and time spent waiting to
+        """
+        call = call if call is not None else {}
+        request = self._open_stream if stream else self.backend.complete
+        attempt = 0
+        TwineGenerator.retry_budget.record_request()
+        while True:
+            TwineGenerator.circuit_breaker.before_call()
+            call['rate_limit_wait'] = call.get('rate_limit_wait', 0.) + TwineGenerator.rate_limiter.acquire()
+            try:
+                response = request(model, prompt, **params)
+            except BackendError as e:
+                if isinstance(e, RateLimitedError):
+                    # The backend is up, just busy. The rate limiter backs off, the circuit breaker is for outages.
+                    TwineGenerator.circuit_breaker.record_success()
+                    TwineGenerator.rate_limiter.decrease()
+                else:
+                    TwineGenerator.circuit_breaker.record_failure()
+                if attempt >= MAX_RETRIES or not TwineGenerator.retry_budget.try_retry():
+                    raise
+                delay = backoff_delay(attempt, RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+                print(f'{e}\nretrying in {delay:.1f}s...')
+                time.sleep(delay)
+                attempt += 1
+                call['retries'] = attempt
+                call['backoff_wait'] = call.get('backoff_wait', 0.) + delay
+                continue
+            TwineGenerator.circuit_breaker.record_success()
+            TwineGenerator.rate_limiter.increase()
+            return response
+
+    def summarize(self, passage, clean_passage=True, use_cache=None):
         """
         Use GPT-3 as a zero-shot summarization for the given passage.
 
         :param clean_passage: (bool) whether to clean the passage of extraneous twee formatting
+        :param use_cache: pass False to skip the cache for this call
         """
 
         if clean_passage:
             passage = utils.passage_to_text(passage)
-        prompt = ZERO_SHOT.format(passage.strip())
-        model = 'davinci'  # It doesn't really work with curie
-        response = openai.Completion.create(
-            model=model,
-            prompt=prompt,
-            temperature=0.7,
-            max_tokens=280,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop='.',
-        )
-
-        response = response['choices'][0]['text']
-        return response.strip() + '.'
+        # The completion stops at the full stop, so put it back
+        return self._summarize(passage.strip(), get_zero_shot(), SUMMARY_PARAMS, use_cache, ending='.')
+
+    def summarize_story(self, story, use_cache=None):
+        """
+        Summarize a story so far (eg a rolling summary followed by the next passage) in a few sentences, so that
+        summaries of summaries keep the story's history rather than being cut down to one sentence.
+
+        :param story: plain text, without twee formatting
+        :param use_cache: pass False to skip the cache for this call
+        """
+        return self._summarize(story.strip(), get_story_zero_shot(), STORY_SUMMARY_PARAMS, use_cache)
+
+    def _summarize(self, text, zero_shot, params, use_cache=None, ending=''):
+        """
+        Complete the zero shot summarization prompt for the text, through the summary cache.
+
+        :param ending: added to the end of the completion
+        """
+        use_cache = self._use_cache(use_cache)
+        # Summaries are only kept in the summary cache, not the completion cache too
+        summaries = TwineGenerator.get_summary_cache() if use_cache else None
+        key = hash_key(text, SUMMARY_MODEL, params, str(self.backend))
+        summary = summaries.get(key) if use_cache else None
+        prompt = zero_shot.format(text)
+        with TwineGenerator.telemetry.call('summary', SUMMARY_MODEL) as call:
+            if summary is not None:
+                self._record_tokens(call, prompt, summary, cache='hit')
+                return summary
+            response = self._request(SUMMARY_MODEL, prompt, params, call=call)
+            summary = response['choices'][0]['text'].strip() + ending
+            self._record_tokens(call, prompt, summary, response, cache='miss' if use_cache else 'skip')
+
+        if use_cache:
+            summaries.set(key, summary)
+        return summary
+
+    def summarize_many(self, passages, clean_passage=True, use_cache=None, max_workers=SUMMARY_CONCURRENCY):
+        """
+        Summarize many passages, eg a whole story. Passages whose cleaned text is identical are only summarized once,
+        and up to max_workers summaries are requested at once.
+
+        :param clean_passage: (bool) whether to clean the passages of extraneous twee formatting
+        :param use_cache: pass False to skip the cache for these calls
+        :return: a list of summaries, in the same order as the passages
+        """
+        texts = [(utils.passage_to_text(passage) if clean_passage else passage).strip() for passage in passages]
+        unique_texts = list(dict.fromkeys(texts))
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            summaries = executor.map(lambda text: self.summarize(text, False, use_cache=use_cache), unique_texts)
+            text_to_summary = dict(zip(unique_texts, summaries))
+        return [text_to_summary[text] for text in texts]
 
-    @staticmethod
-    def _mock_generate(prompt):
-        time.sleep(1)
-        result = {}
-        result['completion'] = \
-            """\"You don't have to answer, I've seen it a million times." She pulls out a wallet and hands you a business card.<newline>DR. CHAE YEON-SEOK<newline>SPECIALIST<newline>[["Specialist?"|specialist]]<newline>[["..."|dotdotdot]]<|end|>"""
-        return result
 
 # Usage: python src/external_model.py
 if __name__ == '__main__':
     mem = "This happened sometime ago now, but I still treasure this memory close to my heart. I've always wanted to execute the perfect date for a girl, and that day would come when I met my Loretta. One night, I really wanted to do something romantic for her. I'm twenty two but my ideas are rather old fashioned. I decided a surprise picnic would be a perfect date for Loretta. I thought she'd love it. I ended up secretly buying all her favorite foods I could think of, creating a playlist of all our favorite love songs, and packing her favorite blankets. Everything was going to plan. Well, until the day I decided to actually put my plan into motion. On the day of the picnic, I finally realized the one thing I forgot to do while planning this picnic, check the weather. It ended up pouring down hard that day. However, that didn't stop my plans. Instead of feeling defeated and calling it a night I decided to execute a quick plan B. I had brought Loretta to my room, and I began to set the stage. With the lights dimmed and a fake fireplace roaring on my tv, I turned on my blue tooth speaker and prepared the playlist I made. I had set up the blankets and cups, along with everything else I had ready for the picnic, and had everything laid out nicely on the clear floor. Loretta was overjoyed that I had gone through all this trouble for her. After we ate she snuggled up with me as we kissed and let the music play until it's end. We're still happily together and of course now I always remember to check the weather, but Loretta still says that night was very special to her, and it is to me as well! "
     # ex = "She was gorgeous and I was in love with her. When we made out for the first time, the world came to a halt. It literally blew up. No one survived, except for us."
     ex = "Long ago there lived a man in a room with an ipad. The man was obsessed with a game called townscaper. The game was played by desiging towns. There was no winning or losing in the game, it was purely for fun."
-    sum = TwineGenerator.summarize(ex, False)
+    sum = TwineGenerator('naive').summarize(ex, False)
     print('summary: ', sum)
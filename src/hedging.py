@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError, wait
+from telemetry import percentile
+
+
+class Hedger:
+    def __init__(self, percentile=95, min_samples=20, window=200, max_workers=16, clock=time.perf_counter):
+        """
+        Cut the tail latency of slow calls by hedging: if a call hasn't returned within the given percentile of the
+        latencies seen so far, send a duplicate and take whichever answers first. The other one is cancelled if it
+        hasn't started, or its result is discarded when it arrives.
+
+        Hedging at the pth percentile sends roughly (100 - p)% extra calls.
+
+        :param percentile: how slow (0-100) a call must be, relative to recent calls, before it is hedged
+        :param min_samples: how many calls to observe before hedging any
+        :param window: how many recent latencies the percentile is taken over
+        :param max_workers: how many calls (including hedges) can be in flight at once
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.clock = clock
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'<Hedger p{self.percentile}, {self.hedged} hedged, {self.hedge_wins} won by the hedge>'
+
+    def delay(self):
+        """
+        :return: how long to wait for a call before hedging it, or None if there aren't enough samples yet
+        """
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return percentile(list(self.latencies), self.percentile)
+
+    def observe(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+
+    def call(self, fn, discard=None):
+        """
+        Call fn(), hedging it if it is slow. If both calls fail, the last error is raised.
+
+        :param discard: called with the losing result, eg to close a stream nobody will read
+        """
+        primary = self._executor.submit(self._timed, fn)
+        try:
+            return primary.result(timeout=self.delay())
+        except TimeoutError:
+            pass
+
+        with self._lock:
+            self.hedged += 1
+        hedge = self._executor.submit(self._timed, fn)
+        pending, error = {primary, hedge}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                for other in pending:
+                    self._abandon(other, discard)
+                if future is hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return future.result()
+        raise error
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _timed(self, fn):
+        start = self.clock()
+        result = fn()
+        self.observe(self.clock() - start)
+        return result
+
+    @staticmethod
+    def _abandon(future, discard):
+        if future.cancel() or discard is None:
+            return
+        future.add_done_callback(lambda f: discard(f.result()) if f.exception() is None else None)
@@ -0,0 +1,138 @@
+"""
+A small stand-in for an OpenAI compatible completion endpoint, for running spindle (and throughput tests) offline.
+
+Usage: python src/local_server.py [port] [latency in seconds]
+    then: SPINDLE_BACKEND=http SPINDLE_BASE_URL=http://localhost:8000/v1 python src/spindle.py
+"""
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import twee_utils as utils
+
+DEFAULT_PORT = 8000
+
+SENTENCES = [
+    "The door creaks open onto a corridor you don't remember.",
+    "Somewhere below, a dog barks twice and then goes quiet.",
+    "She hands you a folded note and won't meet your eyes.",
+    "The rain has not let up since morning.",
+    "You find a key under the mat, cold and slightly bent.",
+    "A voice on the radio repeats your name.",
+]
+LINK_TEXTS = ['Go inside', 'Wait', 'Read the note', 'Follow the voice', 'Turn back', 'Knock']
+
+
+def make_stand_in_completion(prompt, rng=random):
+    """
+    A plausible twee passage body in the generation format: a few sentences and one to three links.
+    """
+    lines = rng.sample(SENTENCES, rng.randint(1, 3))
+    lines += [f'[[{text}|{text.lower()}]]' for text in rng.sample(LINK_TEXTS, rng.randint(1, 3))]
+    return ' ' + utils.NL.join(lines) + utils.END
+
+
+def make_response(model, prompts, n=1, stop=None, rng=random, make_completion=make_stand_in_completion):
+    """
+    A response in the OpenAI completion format. As with the real API, choices for the ith prompt are at indices
+    i * n through i * n + n - 1.
+
+    :param make_completion: a function (prompt, rng) -> completion
+    """
+    choices = []
+    for prompt in prompts:
+        for _ in range(n):
+            text = make_completion(prompt, rng)
+            for s in ([stop] if isinstance(stop, str) else stop or []):
+                text = text.split(s)[0]
+            choices.append({'text': text, 'index': len(choices), 'logprobs': None, 'finish_reason': 'stop'})
+    return {
+        'id': f'cmpl-local-{rng.randint(0, 10 ** 9)}',
+        'object': 'text_completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': choices,
+    }
+
+
+class CompletionHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+    latency = 0.
+
+    def do_POST(self):
+        if self.path.rstrip('/') not in ('/v1/completions', '/completions'):
+            self._send(404, {'error': {'message': f'No route {self.path}'}})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        prompts = request.get('prompt', '')
+        prompts = prompts if isinstance(prompts, list) else [prompts]
+
+        response = make_response(request.get('model'), prompts, n=request.get('n', 1), stop=request.get('stop'))
+        if request.get('stream'):
+            self._stream(response)
+            return
+        time.sleep(self.latency)
+        self._send(200, response)
+
+    def _stream(self, response):
+        """
+        Send the first choice back a few characters at a time as server sent events, spreading the latency out
+        over the chunks.
+        """
+        text = response['choices'][0]['text']
+        chunks = [text[i:i + 8] for i in range(0, len(text), 8)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        for chunk in chunks:
+            time.sleep(self.latency / len(chunks))
+            event = dict(response, choices=[{'text': chunk, 'index': 0, 'logprobs': None, 'finish_reason': None}])
+            self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def _send(self, status, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=DEFAULT_PORT, latency=0., handler=CompletionHandler, block=True):
+    """
+    Start the stand-in server.
+
+    :param port: 0 picks a free port, see server.server_port
+    :param latency: seconds to wait before answering each request
+    :param block: serve forever on this thread, otherwise serve on a daemon thread and return the server
+    """
+    handler = type(handler.__name__, (handler,), {'latency': latency})
+    server = ThreadingHTTPServer(('localhost', port), handler)
+    server.daemon_threads = True
+    if not block:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    print(f'Serving completions on http://localhost:{server.server_port}/v1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return server
+
+
+if __name__ == '__main__':
+    serve(
+        port=int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT,
+        latency=float(sys.argv[2]) if len(sys.argv) > 2 else 0.,
+    )
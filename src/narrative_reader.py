@@ -1,11 +1,11 @@
 import os
 from abc import ABC, abstractmethod
-from transformers import AutoTokenizer, AutoModelForTokenClassification
-from transformers import pipeline
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
 import threading, time, sys, itertools, random, os
-import spacy, textacy
 from twee_utils import dedupe_in_order, passage_to_text, split_lines, unsplit_lines
+from disk_cache import DiskCache, hash_key
+# spaCy, textacy and transformers are slow to import, so they are only imported when the models are first used
 
 PRONOUN_STOP_LIST = {'what', 'there', 'anything', 'nothing', 'it', 'something', 'everything', 'all', 'some'}
 
@@ -46,10 +46,50 @@ TAG_TO_PLURAL_DESC = {
 # We always want to mention how many locations, people there are in the context, even if there are 0
 ENTS_TO_ALWAYS_INCLUDE = ['LOC', 'PER']
 
-# Whether to force a BERT download
-REDOWNLOAD_BERT = True
+SPACY_MODEL = 'en_core_web_lg'
+# Entities come from BERT, so spaCy's own NER is never loaded
+SPACY_EXCLUDE = ['ner']
+BERT_MODEL = 'dslim/bert-base-NER'
+# Where BERT is downloaded to and loaded from
+MODEL_CACHE_DIR = os.getenv('SPINDLE_MODEL_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models'))
+# Whether to force a BERT download, eg if the cached copy is corrupt
+REDOWNLOAD_BERT = False
 DONE = False
+# Whether readers extract narrative elements through the NLP daemon (see nlp_daemon.py) when it is running.
+# Off unless SPINDLE_NLP_DAEMON is set.
+USE_NLP_DAEMON = bool(os.getenv('SPINDLE_NLP_DAEMON'))
+# How many passages spaCy and BERT process at once when extracting from many passages
+NLP_BATCH_SIZE = 32
+# Whether readers keep the narrative elements of passages they've read between sessions
+USE_ELEMENT_CACHE = True
+# Where narrative elements are cached, keyed by passage text, extraction version and model versions
+ELEMENT_CACHE_PATH = os.path.join('spindle_cache', 'narrative_elements.sqlite3')
+MAX_CACHED_ELEMENTS_BYTES = 256 * 1024 * 1024
+# The packages whose versions narrative elements are cached under, so upgrading a model invalidates its elements
+MODEL_PACKAGES = [SPACY_MODEL, 'spacy', 'transformers', 'textacy']
+
+# What each extraction version needs, so that it only runs (and loads) that:
+#   components: the spaCy pipeline components to run, or None if the version doesn't need spaCy at all
+#   extractors: the narrative elements it extracts. entities need BERT.
+# Pronouns only need part of speech tags, events (subject verb object triples) the dependency parse and lemmas.
+PIPELINE_PROFILES = {
+    1.1: {
+        'components': None,
+        'extractors': [],
+    },
+    1.2: {
+        'components': ['tok2vec', 'tagger', 'attribute_ruler'],
+        'extractors': ['pronouns', 'entities'],
+    },
+    1.3: {
+        'components': ['tok2vec', 'tagger', 'attribute_ruler', 'lemmatizer', 'parser'],
+        'extractors': ['pronouns', 'entities', 'events'],
+    },
+}
 MAX_EVENTS_LENGTH = 16
+# A word in an event, which is all the author functions need of a spaCy token. Unlike a token it doesn't keep its
+# passage's whole Doc alive, and it can be pickled, cached and sent between processes.
+EventToken = namedtuple('EventToken', ['text', 'lemma_'])
 DEFAULT_COMPONENT_FUNC = lambda x: str(x)
 
 
@@ -81,10 +121,23 @@ class NarrativeReader(ABC):
  
 
 class BasicVersionedReader(NarrativeReader):
+    # Static narrative element cache, shared by every reader
+    element_cache = None
+
     # AnyTree Docs: https://anytree.readthedocs.io/en/2.8.0/
-    def __init__(self, v):
+    def __init__(self, v, use_daemon=USE_NLP_DAEMON, use_cache=USE_ELEMENT_CACHE):
+        """
+        :param use_daemon: extract narrative elements through the NLP daemon when it is running, rather than loading
+            the models in this process. If the daemon can't be reached, the reader falls back to loading them.
+        :param use_cache: serve the narrative elements of passages that have been read before from the element cache,
+            so unchanged passages never go through the models again
+        """
         self.set_extraction_version(v)
         self.author_functions = self._get_author_functions(self.extraction_version)
+        self.profile = get_profile(self.extraction_version)
+        self.use_daemon = use_daemon
+        self.use_cache = use_cache
+        self._client = None
 
     def __str__(self):
         return f'<BasicVersionedReader v{self.extraction_version}>'
@@ -113,35 +166,143 @@ class BasicVersionedReader(NarrativeReader):
         :rtype: str
         """
 
+        context_text = ""
+        for section in self.write_context_sections(full_context).values():
+            context_text += section + " "
+        return context_text
+
+    def write_context_sections(self, full_context):
+        """
+        Like write_context_text, but keep the text describing each type of context component separate,
+        eg so that they can be trimmed to fit a token budget.
+
+        :param full_context: a list, each item (a dict) corresponding to all the narrative elements in that passage
+        :return: an ordered dict mapping context component type -> text
+        """
         # count up top components
         top_context_components = self.trim_context_components(full_context)
 
-        context_text = ""
+        sections = OrderedDict()
         for k, component in top_context_components.items():
             f = self.author_functions.get(k, DEFAULT_COMPONENT_FUNC)
-            context_text += f(component) + " "
-        return context_text
+            sections[k] = f(component)
+        return sections
 
     def make_context_components(self, passage_text):
         """
         :param passage_text: the text from a single passage
         :return: a dict containing all narrative elements in the passage
         """
+        return self.make_many_context_components([passage_text])[0]
 
-        doc = nlp(passage_text)
+    def make_many_context_components(self, passage_texts, batch_size=NLP_BATCH_SIZE):
+        """
+        Like make_context_components for many passages at once, which is several times faster: spaCy and BERT
+        process the passages in batches.
 
-        context_components = {
-            'v': self.extraction_version,
-        }
+        Passages already in the element cache aren't read again, and repeated passages (eg placeholders) are only
+        read once.
 
-        if self.extraction_version >= 1.2:
-            context_components['pronouns'] = extract_pronouns(doc)
-            context_components['entities'] = ner(passage_text)
+        :param passage_texts: the text from each passage
+        :param batch_size: how many passages spaCy and BERT process at once
+        :return: a list of dicts containing all narrative elements in each passage
+        """
+        passage_texts = list(passage_texts)
+        # eg v1.1 has no narrative elements, so it never needs the models
+        if not self.profile['extractors'] or not passage_texts:
+            return [{'v': self.extraction_version} for _ in passage_texts]
+
+        cache = BasicVersionedReader.get_element_cache() if self.use_cache else None
+        many_components = [None] * len(passage_texts)
+        # passage text -> the indices of the passages with that text that still need reading
+        unread = OrderedDict()
+        for i, text in enumerate(passage_texts):
+            cached = cache.get(self._cache_key(text)) if cache is not None else None
+            if cached is not None:
+                many_components[i] = decode_components(cached)
+            else:
+                unread.setdefault(text, []).append(i)
+
+        extracted = self._extract_many(list(unread), batch_size)
+        if cache is not None:
+            # In one transaction
+            cache.set_many(
+                (self._cache_key(text), encode_components(components)) for text, components in zip(unread, extracted)
+            )
+        for text, components in zip(unread, extracted):
+            for i in unread[text]:
+                # Every node gets its own dict, since summaries are added to them
+                many_components[i] = dict(components)
+        return many_components
+
+    def _extract_many(self, passage_texts, batch_size=NLP_BATCH_SIZE):
+        """
+        Run the models over the passages, through the NLP daemon if we're using it.
+        """
+        if not passage_texts:
+            return []
+        extractors = self.profile['extractors']
+        client = self._get_client()
+        if client:
+            try:
+                return client.make_many_context_components(passage_texts, self.extraction_version)
+            except OSError as e:
+                print(f'The NLP daemon is unavailable ({e}), loading the models here instead.')
+                self.use_daemon = False
+
+        components = self.profile['components']
+        if components is None:
+            docs = [None] * len(passage_texts)
+        else:
+            nlp = get_nlp()
+            disable = [name for name in nlp.pipe_names if name not in components]
+            docs = nlp.pipe(passage_texts, batch_size=batch_size, disable=disable)
+        if 'entities' in extractors:
+            entities = ner_many(passage_texts, batch_size=batch_size)
+        else:
+            entities = [None] * len(passage_texts)
 
-        if self.extraction_version >= 1.3:
-            context_components['events'] = extract_events(doc)
+        many_components = []
+        for doc, passage_entities in zip(docs, entities):
+            context_components = {
+                'v': self.extraction_version,
+            }
+
+            if 'pronouns' in extractors:
+                context_components['pronouns'] = extract_pronouns(doc)
+            if 'entities' in extractors:
+                context_components['entities'] = passage_entities
+            if 'events' in extractors:
+                context_components['events'] = extract_events(doc)
+
+            many_components.append(context_components)
+        return many_components
 
-        return context_components
+    def _cache_key(self, passage_text):
+        return hash_key(passage_text, self.extraction_version, SPACY_MODEL, BERT_MODEL, get_model_versions())
+
+    @staticmethod
+    def get_element_cache():
+        """
+        Return the singleton narrative element cache, opening it if it doesn't exist yet.
+        Its stats() report how many passages were served from it.
+        """
+        if BasicVersionedReader.element_cache is None:
+            BasicVersionedReader.element_cache = DiskCache(
+                ELEMENT_CACHE_PATH, max_entries=None, max_bytes=MAX_CACHED_ELEMENTS_BYTES
+            )
+        return BasicVersionedReader.element_cache
+
+    def _get_client(self):
+        """
+        Return a client for the NLP daemon if we should use it and it is running, otherwise None.
+        """
+        if not self.use_daemon:
+            return None
+        if self._client is None:
+            from nlp_daemon import NLPClient  # nlp_daemon imports this module
+            self._client = NLPClient()
+        return self._client if self._client.available() else None
 
     def flatten_context(self, full_context):
         """
@@ -164,8 +325,11 @@ class BasicVersionedReader(NarrativeReader):
             if passage_components.get('entities'):
                 for k, v in passage_components['entities'].items():
                     joined['entities'][k] += v
-            if passage_components.get('events'):
+            # Components extracted at a higher version than ours (eg for comparing versions) have extra elements
+            if passage_components.get('events') and 'events' in joined:
                 joined['events'] += passage_components['events']
+            if passage_components.get('summary'):
+                joined.setdefault('summary', []).append(passage_components['summary'])
 
         return joined
 
@@ -202,15 +366,28 @@ class BasicVersionedReader(NarrativeReader):
         if self.extraction_version >= 1.3:
             top_context_components['events'] = flattened['events']
 
+        # Summaries (see PassageTree.add_summaries) are kept in story order, one per line
+        if flattened.get('summary'):
+            top_context_components['summary'] = '\n'.join(flattened['summary'])
+
         return top_context_components
 
 
-def load_nlp_modules():
+_nlp = None
+_ner_pipeline = None
+_model_versions = None
+_load_lock = threading.Lock()
+
+
+@contextmanager
+def _loading_animation(animate_text, finished='Loaded model.'):
+    """
+    Animate animate_text on the terminal while the body runs.
+    """
     global DONE
 
-    def _animate(animate_text, finished='Loaded model.'):
+    def _animate():
         # ['|', '/', '-', '\\']
-        spaces = ' ' * len(animate_text)
         text_all = [animate_text[:i + 1] for i in range(len(animate_text))]
         for c in itertools.cycle(text_all):  # ['.   ', '..  ', '... ', '....']
             if DONE:
@@ -221,26 +398,103 @@ def load_nlp_modules():
             time.sleep(random.uniform(0.02, 0.2))
         sys.stdout.write(f'\r{finished}                                         \r')
 
-    text = 'Loading English... Reticulating Splines... etc...'
     DONE = False
-    t = threading.Thread(target=_animate, args=(text,))
+    t = threading.Thread(target=_animate)
     t.start()
-    os.environ["TOKENIZERS_PARALLELISM"] = "true"
-    nlp = spacy.load('en_core_web_lg')
-    tokenizer = model = None
     try:
-        tokenizer = AutoTokenizer.from_pretrained("./dslim/bert-base-NER", force_download=REDOWNLOAD_BERT)
-        model = AutoModelForTokenClassification.from_pretrained("./dslim/bert-base-NER", force_download=REDOWNLOAD_BERT)
-    except Exception as e:
-        print(f"Could not load {'tokenizer' if not tokenizer else 'model'}! Try setting REDOWNLOAD_BERT=True in src/narrative_reader.py")
-        os._exit(1)
-    ner_pipeline = pipeline("ner", model=model, tokenizer=tokenizer)
-    DONE = True
-    t.join()
-    return ner_pipeline, nlp
+        yield
+    finally:
+        DONE = True
+        t.join()
 
 
-ner_pipeline, nlp = load_nlp_modules()
+def get_nlp():
+    """
+    Return the spaCy pipeline, loading it the first time it's needed.
+    """
+    global _nlp
+    if _nlp is not None:
+        return _nlp
+    with _load_lock:
+        if _nlp is None:
+            import spacy
+            with _loading_animation('Loading English... Reticulating Splines... etc...'):
+                _nlp = spacy.load(SPACY_MODEL, exclude=SPACY_EXCLUDE)
+    return _nlp
+
+
+def get_model_versions():
+    """
+    Return the installed version of each of MODEL_PACKAGES (None if it isn't installed), without importing them.
+    """
+    global _model_versions
+    if _model_versions is None:
+        try:
+            from importlib.metadata import version, PackageNotFoundError
+        except ImportError:  # Python 3.7
+            from pkg_resources import get_distribution, DistributionNotFound as PackageNotFoundError
+            version = lambda package: get_distribution(package).version
+        versions = {}
+        for package in MODEL_PACKAGES:
+            try:
+                versions[package] = version(package)
+            except PackageNotFoundError:
+                versions[package] = None
+        _model_versions = versions
+    return _model_versions
+
+
+def __getattr__(name):
+    """
+    Keep narrative_reader.nlp and narrative_reader.ner_pipeline working, loading the models when they're first used.
+    """
+    if name == 'nlp':
+        return get_nlp()
+    if name == 'ner_pipeline':
+        return get_ner_pipeline()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_profile(version):
+    """
+    Return the pipeline profile of an extraction version, see PIPELINE_PROFILES.
+    """
+    return PIPELINE_PROFILES[max(v for v in PIPELINE_PROFILES if v <= version)]
+
+
+def get_ner_pipeline():
+    """
+    Return the BERT NER pipeline, loading it the first time it's needed. BERT is downloaded to MODEL_CACHE_DIR once,
+    then loaded from there.
+    """
+    global _ner_pipeline
+    if _ner_pipeline is not None:
+        return _ner_pipeline
+    with _load_lock:
+        if _ner_pipeline is None:
+            os.environ["TOKENIZERS_PARALLELISM"] = "true"
+            from transformers import AutoTokenizer, AutoModelForTokenClassification, pipeline
+            tokenizer = model = None
+            with _loading_animation('Loading BERT... Reticulating Splines... etc...'):
+                try:
+                    tokenizer = AutoTokenizer.from_pretrained(
+                        BERT_MODEL, cache_dir=MODEL_CACHE_DIR, force_download=REDOWNLOAD_BERT
+                    )
+                    model = AutoModelForTokenClassification.from_pretrained(
+                        BERT_MODEL, cache_dir=MODEL_CACHE_DIR, force_download=REDOWNLOAD_BERT
+                    )
+                except Exception as e:
+                    print(f"Could not load {'tokenizer' if not tokenizer else 'model'}! Try setting REDOWNLOAD_BERT=True in src/narrative_reader.py")
+                    os._exit(1)
+                _ner_pipeline = pipeline("ner", model=model, tokenizer=tokenizer)
+    return _ner_pipeline
+
+
+def load_nlp_modules():
+    """
+    Load the models up front rather than on first use, eg before a long run.
+    """
+    return get_ner_pipeline(), get_nlp()
 
 
 def ner(text, verbose=False):
@@ -252,7 +506,23 @@ def ner(text, verbose=False):
         "PER": ["Anna", "Alex"]
         }
     """
-    ner_results = ner_pipeline(text)
+    return join_entities(get_ner_pipeline()(text), verbose=verbose)
+
+
+def ner_many(texts, batch_size=NLP_BATCH_SIZE, verbose=False):
+    """
+    Like ner, for many texts at once, batch_size at a time.
+
+    :return: a list of dicts, one per text
+    """
+    results = get_ner_pipeline()(list(texts), batch_size=batch_size)
+    return [join_entities(ner_results, verbose=verbose) for ner_results in results]
+
+
+def join_entities(ner_results, verbose=False):
+    """
+    Turn the word part entities tagged by the NER pipeline into a dictionary of entity type -> entities.
+    """
     # Not checking that the internal entity type in each word part matches, but should...
     # same_ent_type = lambda x, y: x.split('-')[-1] == y.split('-')[-1]
 
@@ -292,18 +562,70 @@ def ner(text, verbose=False):
     return dict(processed_entities)
 
 
+def embed(text):
+    """
+    The mean of the word vectors in text. en_core_web_lg ships static vectors, so the pipeline doesn't need to run.
+    """
+    return get_nlp().make_doc(text).vector
+
+
 def extract_pronouns(doc):
-    pronouns = []
-    for token in doc:
-        if token.pos_ == 'PRON':
-            pronouns.append(token.text.lower())
+    """
+    Read the pronouns from the doc's token attribute array rather than token by token.
+    """
+    from spacy.attrs import POS, LOWER
+    from spacy.symbols import PRON
+    attributes = doc.to_array([POS, LOWER])
+    if not len(attributes):
+        return []
+    pronouns = [doc.vocab.strings[int(lower)] for lower in attributes[attributes[:, 0] == PRON, 1]]
 
     return dedupe_in_order(pronouns, dont_add=PRONOUN_STOP_LIST)
 
 
 def extract_events(doc):
-    triples = [svo for svo in textacy.extract.subject_verb_object_triples(doc)]
-    return triples
+    """
+    The subject verb object triples in the doc, as compact events (see make_event) rather than spaCy tokens.
+    """
+    import textacy
+    return [make_event(svo) for svo in textacy.extract.subject_verb_object_triples(doc)]
+
+
+def make_event(triple):
+    """
+    Turn a subject verb object triple, each part a list of spaCy tokens or of (text, lemma) pairs, into a tuple of
+    three tuples of EventTokens. Words share their strings with every other event they appear in.
+    """
+    return tuple(tuple(_make_event_token(token) for token in part) for part in triple)
+
+
+def _make_event_token(token):
+    if isinstance(token, (tuple, list)):
+        text, lemma = token
+    else:
+        text, lemma = token.text, token.lemma_
+    return EventToken(sys.intern(text), sys.intern(lemma))
+
+
+def encode_components(components):
+    """
+    Make a passage's narrative elements json serializable, eg to cache them. Events become lists of [text, lemma].
+    """
+    components = dict(components)
+    if 'events' in components:
+        components['events'] = [
+            [[[token.text, token.lemma_] for token in part] for part in triple] for triple in components['events']
+        ]
+    return components
+
+
+def decode_components(components):
+    """
+    The inverse of encode_components.
+    """
+    if 'events' in components:
+        components['events'] = [make_event(triple) for triple in components['events']]
+    return components
 
 
 #### --- Begin Author Functions --- ####
@@ -0,0 +1,203 @@
+"""
+A long lived local daemon that keeps spaCy and the BERT NER pipeline loaded and serves narrative extraction
+(BasicVersionedReader.make_context_components) over a Unix socket, so spindle sessions, notebooks and scripts start
+instantly and share one copy of the models. Readers use it whenever it is running (see BasicVersionedReader), and load
+the models themselves when it isn't.
+
+Usage: python src/nlp_daemon.py [socket path]
+
+The socket lives in a directory only the current user can use, and clients only talk to a daemon their own user runs.
+
+Each message is a 4 byte big endian length followed by that many bytes of compact json.
+    request: {"texts": [passage text, ...], "v": extraction version}
+    response: {"components": [narrative elements, ...]} or {"error": message}
+Events are sent as [subject, verb, object], each a list of [text, lemma] pairs (see narrative_reader.encode_components).
+"""
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import threading
+import narrative_reader
+from narrative_reader import encode_components, decode_components
+
+# Per user: the runtime directory if there is one, otherwise the user's cache directory
+NLP_SOCKET = os.getenv('SPINDLE_NLP_SOCKET', os.path.join(
+    os.getenv('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser('~'), '.cache'), 'spindle', 'nlp.sock'
+))
+HEADER = struct.Struct('>I')
+
+
+def send_message(sock, message):
+    data = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def receive_message(sock):
+    """
+    :return: the next message, or None if the other end closed the connection
+    """
+    header = _receive_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    data = _receive_exactly(sock, HEADER.unpack(header)[0])
+    if data is None:
+        raise ConnectionError('Connection closed partway through a message')
+    return json.loads(data.decode('utf-8'))
+
+
+def _receive_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class ExtractionHandler(socketserver.BaseRequestHandler):
+    """
+    Serve extraction requests on a connection until the client closes it.
+    """
+
+    def handle(self):
+        while True:
+            try:
+                request = receive_message(self.request)
+            except (ConnectionError, ValueError):
+                return
+            if request is None:
+                return
+            try:
+                many_components = self.server.make_components(request['texts'], request['v'])
+                response = {'components': [encode_components(components) for components in many_components]}
+            except Exception as e:
+                response = {'error': f'{type(e).__name__}: {e}'}
+            send_message(self.request, response)
+
+
+class ExtractionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, make_components=None):
+        """
+        :param make_components: a function (passage texts, extraction version) -> their narrative elements, defaults
+            to in-process BasicVersionedReaders. They don't cache, since the clients do.
+        """
+        self.readers = {}
+        self.make_components = make_components if make_components else self._make_components
+        # The models aren't guaranteed to be thread safe, so connections take turns
+        self._lock = threading.Lock()
+        super().__init__(path, ExtractionHandler)
+
+    def _make_components(self, texts, version):
+        with self._lock:
+            if version not in self.readers:
+                self.readers[version] = narrative_reader.BasicVersionedReader(
+                    version, use_daemon=False, use_cache=False
+                )
+            return self.readers[version].make_many_context_components(texts)
+
+
+def serve(path=NLP_SOCKET, make_components=None, block=True):
+    """
+    Serve extraction on a Unix socket at path, replacing a stale socket if there is one. The socket can only be used
+    by the current user.
+
+    :param block: serve forever, otherwise serve on a daemon thread and return the server
+    :raise: FileExistsError if there is something other than a socket at path
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise FileExistsError(f'{path} exists and is not a socket, not replacing it')
+        os.unlink(path)
+    server = ExtractionServer(path, make_components)
+    os.chmod(path, 0o600)
+    if not block:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    print(f'Serving narrative extraction on {path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+class NLPClient:
+    def __init__(self, path=NLP_SOCKET, timeout=60.):
+        """
+        A connection to the daemon, shared by every thread.
+
+        :param timeout: seconds to wait for a response
+        """
+        self.path = path
+        self.timeout = timeout
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'<NLPClient {self.path}>'
+
+    def available(self):
+        """
+        Whether there is a daemon socket at the path, owned by the current user.
+        """
+        try:
+            info = os.lstat(self.path)
+        except OSError:
+            return False
+        return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+    def make_context_components(self, passage_text, version):
+        """
+        Have the daemon extract the narrative elements from a passage.
+
+        :raise: ConnectionError (or another OSError) if the daemon isn't there, RuntimeError if extraction failed
+        """
+        return self.make_many_context_components([passage_text], version)[0]
+
+    def make_many_context_components(self, passage_texts, version):
+        """
+        Have the daemon extract the narrative elements from many passages, which it does in batches.
+        """
+        with self._lock:
+            # A connection the daemon has since dropped only fails when it is used, so try a fresh one once
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        self._sock.settimeout(self.timeout)
+                        self._sock.connect(self.path)
+                    send_message(self._sock, {'texts': list(passage_texts), 'v': version})
+                    response = receive_message(self._sock)
+                    if response is None:
+                        raise ConnectionError('The NLP daemon closed the connection')
+                    break
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+        if 'error' in response:
+            raise RuntimeError(f"The NLP daemon couldn't extract the narrative elements: {response['error']}")
+        return [decode_components(components) for components in response['components']]
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+if __name__ == '__main__':
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else NLP_SOCKET
+    narrative_reader.load_nlp_modules()
+    serve(socket_path)
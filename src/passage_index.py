@@ -0,0 +1,65 @@
+import numpy as np
+
+
+class PassageIndex:
+    def __init__(self, capacity=64, dtype=np.float32):
+        """
+        A compact in-memory vector index: unit vectors in one growing matrix, searched by cosine similarity.
+
+        :param capacity: how many vectors to make room for up front. The matrix doubles whenever it fills up.
+        :param dtype: the dtype the vectors are stored as
+        """
+        self.items = []
+        self._vectors = None
+        self._capacity = capacity
+        self._dtype = dtype
+
+    def __len__(self):
+        return len(self.items)
+
+    def __str__(self):
+        return f'<PassageIndex {len(self)} vectors>'
+
+    @property
+    def vectors(self):
+        """
+        The unit vectors of the items, one row each, in the order they were added.
+        """
+        return self._vectors[:len(self)] if self._vectors is not None else np.zeros((0, 0), self._dtype)
+
+    def add(self, item, vector):
+        """
+        Add item to the index under vector. Zero vectors (eg text with no known words) are kept but never match.
+        """
+        vector = np.asarray(vector, dtype=self._dtype)
+        norm = np.linalg.norm(vector)
+        if self._vectors is None:
+            self._vectors = np.zeros((self._capacity, vector.shape[0]), self._dtype)
+        elif len(self) == self._vectors.shape[0]:
+            self._vectors = np.concatenate([self._vectors, np.zeros_like(self._vectors)])
+        self._vectors[len(self)] = vector / norm if norm else vector
+        self.items.append(item)
+
+    def search(self, vector, k, exclude=(), in_order=False):
+        """
+        Find the k items most similar to vector.
+
+        :param exclude: items not to return
+        :param in_order: return the items in the order they were added rather than most similar first
+        :return: a list of (item, cosine similarity). Items that aren't similar at all are left out.
+        """
+        if not len(self) or k <= 0:
+            return []
+        vector = np.asarray(vector, dtype=self._dtype)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return []
+        scores = self.vectors @ (vector / norm)
+        excluded = {id(item) for item in exclude}
+        for i, item in enumerate(self.items):
+            if id(item) in excluded:
+                scores[i] = -np.inf
+        k = min(k, len(self))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = np.sort(best) if in_order else best[np.argsort(-scores[best])]
+        return [(self.items[i], float(scores[i])) for i in best if scores[i] > 0]
@@ -0,0 +1,147 @@
+import random
+import threading
+import time
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of calling a backend that has failed too many times in a row.
+    """
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None, min_rate=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        A client side rate limiter, shared between threads. Each request takes a token, tokens refill at `rate` per second.
+
+        The rate adapts: decrease() halves it when the server tells us to slow down (eg a rate limit error)
+        and increase() creeps it back up towards the starting rate after each success.
+
+        :param rate: the maximum number of requests per second
+        :param capacity: how many requests can be made in a burst, defaults to one second's worth
+        :param min_rate: never slow down past this many requests per second
+        """
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = float(min_rate) if min_rate else self.max_rate / 16
+        self.capacity = float(capacity) if capacity else max(1., self.max_rate)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """
+        Block until `tokens` tokens are available and take them.
+
+        :return: how many seconds we waited
+        """
+        waited = 0.
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                wait = (tokens - self.tokens) / self.rate
+            self._sleep(wait)
+            waited += wait
+
+    def decrease(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def increase(self, step=None):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + (step if step else self.max_rate / 16))
+
+
+class RetryBudget:
+    def __init__(self, ratio=0.2, min_retries=10):
+        """
+        Limit retries to a fraction of all requests, so that an outage doesn't turn every request into a retry storm.
+        Each request deposits `ratio` retries into the budget, each retry withdraws one.
+
+        :param ratio: how many retries are allowed per request made
+        :param min_retries: the budget never holds less than this many retries to start with and never more than
+            this many plus what requests have earned
+        """
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.balance = float(min_retries)
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.balance = min(self.balance + self.ratio, self.min_retries + 100 * self.ratio)
+
+    def try_retry(self):
+        """
+        :return: True (and spend from the budget) if a retry is allowed
+        """
+        with self._lock:
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            return False
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30., clock=time.monotonic):
+        """
+        Stop calling a backend that is clearly down.
+        After `failure_threshold` failures in a row the circuit opens and calls fail fast with CircuitOpenError.
+        Once `reset_timeout` seconds have passed a single trial call is let through; if it succeeds the circuit closes.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = CircuitBreaker.CLOSED
+        self._opened_at = None
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'<CircuitBreaker {self.state} ({self.failures} failures)>'
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if the call shouldn't be made.
+        """
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return
+            if self.state == CircuitBreaker.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                return
+            raise CircuitOpenError(
+                f'Backend failed {self.failures} times in a row, not calling it again for {self.reset_timeout}s'
+            )
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = CircuitBreaker.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CircuitBreaker.OPEN
+                self._opened_at = self._clock()
+
+
+def backoff_delay(attempt, base=1., cap=60.):
+    """
+    Exponential backoff with full jitter: a random delay between 0 and base * 2^attempt seconds (at most cap).
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
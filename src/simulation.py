@@ -0,0 +1,148 @@
+"""
+A completion backend that simulates the model in process, for load testing spindle's concurrency, retries and
+scheduling locally and at scale: completions are synthetic twee with a varying number of links, latencies are drawn
+from a configurable distribution, and rate limits, timeouts and malformed twee are injected at configurable rates.
+
+    SPINDLE_BACKEND=simulate SPINDLE_SIMULATION='{"rate_limit_rate": 0.1}' python src/spindle.py
+"""
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from backends import CompletionBackend, BackendError, RateLimitedError, register_backend
+from local_server import SENTENCES, make_response
+import twee_utils as utils
+
+VERBS = ['open', 'follow', 'search', 'leave', 'ask about', 'hide behind', 'climb', 'listen to', 'take', 'burn']
+NOUNS = ['the door', 'the stranger', 'the well', 'the letter', 'the radio', 'the stairs', 'the garden', 'the lamp',
+         'the train', 'the mirror', 'the cellar', 'the dog']
+
+# Each draws a latency in seconds given a random number generator, the mean latency and a spread
+LATENCY_DISTRIBUTIONS = {
+    'constant': lambda rng, mean, spread: mean,
+    'uniform': lambda rng, mean, spread: rng.uniform(max(0., mean - spread), mean + spread),
+    'exponential': lambda rng, mean, spread: rng.expovariate(1 / mean) if mean > 0 else 0.,
+    # spread is the sigma of the underlying normal, so a spread of 1 or more gives a long tail
+    'lognormal': lambda rng, mean, spread: rng.lognormvariate(math.log(mean) - spread ** 2 / 2, spread) if mean > 0 else 0.,
+}
+
+
+def make_simulated_completion(prompt, rng=random, max_links=4):
+    """
+    A twee passage body in the generation format: a few sentences and up to max_links links, some of them to
+    passages nobody has linked to before so that stories keep growing.
+    """
+    lines = rng.sample(SENTENCES, rng.randint(1, 4))
+    for _ in range(rng.randint(0, max_links)):
+        target = f'{rng.choice(VERBS)} {rng.choice(NOUNS)}'
+        lines.append(f'[[{target.capitalize()}|{target}]]' if rng.random() < 0.5 else f'[[{target}]]')
+    return ' ' + utils.NL.join(lines) + utils.END
+
+
+def make_malformed(completion, rng=random):
+    """
+    Break a completion the way the model sometimes does: a link missing a bracket, a passage cut off partway through
+    a link, or a macro that is never closed.
+    """
+    links = list(re.finditer(r'\[\[.*?]]', completion))
+    breakage = rng.choice(['unclosed_macro'] + (['missing_bracket', 'truncated_link'] if links else []))
+    if breakage == 'missing_bracket':
+        link = rng.choice(links)
+        return completion[:link.end() - 1] + completion[link.end():]
+    if breakage == 'truncated_link':
+        link = rng.choice(links)
+        return completion[:link.start() + (link.end() - link.start()) // 2]
+    return completion.replace(utils.END, f' <<if $visited{utils.END}')
+
+
+@register_backend('simulate')
+class SimulatedBackend(CompletionBackend):
+    def __init__(self, latency='lognormal', mean_latency=1., latency_spread=0.5, rate_limit_rate=0., timeout_rate=0.,
+                 malformed_rate=0., timeout=30., max_links=4, seed=None, sleep=time.sleep):
+        """
+        :param latency: the latency distribution, one of LATENCY_DISTRIBUTIONS
+        :param mean_latency: the mean seconds a request takes
+        :param latency_spread: how much latencies vary, see LATENCY_DISTRIBUTIONS
+        :param rate_limit_rate: the fraction of requests that fail straight away with RateLimitedError
+        :param timeout_rate: the fraction of requests that hang for timeout seconds then fail with BackendError
+        :param malformed_rate: the fraction of completions that come back as invalid twee
+        :param timeout: how long a timed out request hangs for
+        :param max_links: the most links a completion can have (it may have none)
+        :param seed: seed the random number generator, for repeatable runs
+        """
+        if latency not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"No latency distribution {latency}, must be one of: {', '.join(LATENCY_DISTRIBUTIONS)}")
+        self.latency = latency
+        self.mean_latency = mean_latency
+        self.latency_spread = latency_spread
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.malformed_rate = malformed_rate
+        self.timeout = timeout
+        self.max_links = max_links
+        self.sleep = sleep
+        self.stats = Counter()  # requests, and the errors and malformed completions injected
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'<SimulatedBackend {self.latency} {self.mean_latency}s>'
+
+    def complete(self, model, prompt, **params):
+        latency = self._start_request()
+        self.sleep(latency)
+        return self._make_response(model, prompt, params)
+
+    def stream(self, model, prompt, **params):
+        """
+        The first chunk arrives after a fifth of the latency, the rest of the words are spread over the remainder.
+        """
+        latency = self._start_request()
+        text = self._make_response(model, prompt, params)['choices'][0]['text']
+        chunks = re.findall(r'\S+\s*|\s+', text) or ['']
+        self.sleep(latency / 5 if len(chunks) > 1 else latency)
+        for i, chunk in enumerate(chunks):
+            if i:
+                self.sleep(latency * 4 / 5 / (len(chunks) - 1))
+            yield chunk
+
+    def _start_request(self):
+        """
+        Count the request and decide how it goes.
+
+        :return: how long it takes
+        :raise: the error injected into it, if any
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            draw = self._rng.random()
+            if draw < self.rate_limit_rate:
+                self.stats['rate_limited'] += 1
+                error = RateLimitedError('Simulated rate limit')
+            elif draw < self.rate_limit_rate + self.timeout_rate:
+                self.stats['timed_out'] += 1
+                error = BackendError(f'Simulated timeout after {self.timeout}s')
+            else:
+                error = None
+            latency = LATENCY_DISTRIBUTIONS[self.latency](self._rng, self.mean_latency, self.latency_spread)
+        if isinstance(error, RateLimitedError):
+            raise error
+        if error:
+            self.sleep(self.timeout)
+            raise error
+        return latency
+
+    def _make_completion(self, prompt, rng):
+        completion = make_simulated_completion(prompt, rng, self.max_links)
+        if rng.random() < self.malformed_rate:
+            self.stats['malformed'] += 1
+            completion = make_malformed(completion, rng)
+        return completion
+
+    def _make_response(self, model, prompt, params):
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        with self._lock:
+            return make_response(model, prompts, n=params.get('n', 1), stop=params.get('stop'), rng=self._rng,
+                                 make_completion=self._make_completion)
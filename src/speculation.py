@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Speculator:
+    def __init__(self, generate, max_in_flight=2, max_kept=8):
+        """
+        Generate passages in the background before the user asks for them, eg while they are choosing what to write
+        next. A speculated passage is only handed over if it was generated from exactly the same context.
+
+        :param generate: a function (title, context) -> passage, called from background threads
+        :param max_in_flight: how many passages can be generating at once. Further speculation is ignored.
+        :param max_kept: how many passages (finished or not) to hold on to. The least recently speculated are
+            thrown away past this.
+        """
+        self.generate = generate
+        self.max_in_flight = max_in_flight
+        self.max_kept = max_kept
+        self.used = 0
+        self.wasted = 0
+        self._passages = OrderedDict()  # (title, context) -> future, least recently speculated first
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'<Speculator {len(self._passages)} passages, {self.used} used, {self.wasted} wasted>'
+
+    def speculate(self, title, context):
+        """
+        Start generating the passage for title in the background, unless it already is or we are at our budget.
+        """
+        key = (title, context)
+        with self._lock:
+            if key in self._passages:
+                self._passages.move_to_end(key)
+                return
+            in_flight = sum(not future.done() for future in self._passages.values())
+            if in_flight >= self.max_in_flight:
+                return
+            self._passages[key] = self._executor.submit(self.generate, title, context)
+            while len(self._passages) > self.max_kept:
+                _, future = self._passages.popitem(last=False)
+                self._throw_away(future)
+
+    def take(self, title, context):
+        """
+        Hand over the passage speculated for this title and context, waiting for it if it is still being generated.
+
+        :return: the passage, or None if it wasn't speculated (or failed)
+        """
+        with self._lock:
+            future = self._passages.pop((title, context), None)
+        if future is None:
+            return None
+        try:
+            passage = future.result()
+        except Exception as e:
+            print(f'Speculative generation of {title} failed: {e}')
+            return None
+        self.used += 1
+        return passage
+
+    def discard(self, title):
+        """
+        Throw away anything speculated for title, eg because the user wrote it themselves.
+        """
+        with self._lock:
+            for key in [key for key in self._passages if key[0] == title]:
+                self._throw_away(self._passages.pop(key))
+
+    def shutdown(self):
+        with self._lock:
+            for future in self._passages.values():
+                self._throw_away(future)
+            self._passages.clear()
+        self._executor.shutdown(wait=False)
+
+    def _throw_away(self, future):
+        future.cancel()
+        self.wasted += 1
@@ -1,16 +1,39 @@
 import os, re, logging
 from sys import argv
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
 import twee_utils as utils
 from display import make_selection, clear, italic, bold, italic_start, italic_end
-from external_model import TwineGenerator
+from backends import BackendError
+from external_model import TwineGenerator, PASSAGE_PARAMS
+from rate_limit import CircuitOpenError
+from speculation import Speculator
 from contextual_tree import PassageTree
 from narrative_reader import BasicVersionedReader
+from token_budget import TokenBudget
 
 VERBOSE = False
 
 GEN_COUNT = 16
 DEFAULT_GEN_COUNT = 16
 MAX_GEN_COUNT = 99
+# How many completions the (f) command keeps in flight at once. 1 generates one passage at a time.
+GEN_CONCURRENCY = 4
+# How many titles the (f) command sends in each completion request. Batches share the request overhead and rate limit,
+# but each batch is only committed once its slowest passage is done.
+GEN_BATCH_SIZE = 1
+# How many candidate passages to sample for each title. The best is used and the rest are kept as alternates.
+# Candidates can't be streamed or batched.
+GEN_CANDIDATES = 1
+# Show passages generated with (g) as they are written rather than all at once
+STREAM = True
+# Send a duplicate of passage requests that are unusually slow, and show whichever passage comes back first.
+# Off by default, since the duplicates are paid for (roughly 5% more requests).
+HEDGE = False
+# Generate the likely next passages in the background while the user decides what to do
+SPECULATE = False
+SPECULATION_IN_FLIGHT = 2  # how many passages to generate in the background at once
+SPECULATION_KEPT = 8  # how many passages the user hasn't taken (yet) to hold on to
 
 DATA_DIR = './generated_games/'
 TWEE_DIRS = ['../twee/', './twee/']
@@ -26,19 +49,152 @@ PRESET_CONFIGS = [
 # 1 - no context
 # 2 - LOC and PER NER elements, pronouns
 # 3 - All NER elements, pronouns, bulleted events
-CONFIG = PRESET_CONFIGS[int(argv[1]) - 1] if len(argv) > 1 else PRESET_CONFIGS[2]
-
-# Construct a contextual GPT-3 engine
-generator = TwineGenerator(CONFIG[0])
+# compare - generate each passage with every configuration and pick the best
+COMPARE = len(argv) > 1 and argv[1] == 'compare'
+CONFIG = PRESET_CONFIGS[int(argv[1]) - 1] if len(argv) > 1 and argv[1].isdigit() else PRESET_CONFIGS[2]
+
+# Construct a contextual GPT-3 engine. Passages the user is waiting for are hedged against slow requests.
+generator = TwineGenerator(CONFIG[0], hedge=HEDGE)
+# and a quiet one for generating in the background
+background_generator = TwineGenerator(CONFIG[0], verbose=False, backend=generator.backend)
 # Decide which version of narrative extraction to use
 PassageTree.reader = BasicVersionedReader(CONFIG[1])
 USE_CONTEXT = CONFIG[2]
+# How much of the story the context covers, see contextual_tree.CONTEXT_MODES. 'summary' keeps it the same size
+# however deep the story goes, at the cost of summarizing each passage with the quiet background generator. The
+# summaries are made when the context is built, so the first generation past each new passage waits on one.
+# 'retrieval' keeps it the same size too, drawing on the passages most relevant to the title.
+PassageTree.context_mode = 'path'
+PassageTree.summarizer = background_generator.summarize_story
+# When comparing, passages are extracted once at the highest version (CONFIG), and each configuration writes its
+# context from those elements with a reader of its own version, so the NLP models are only loaded and run once
+COMPARE_GENERATORS = {
+    name: TwineGenerator(name, verbose=False, backend=generator.backend) for name, _, _ in PRESET_CONFIGS
+} if COMPARE else {}
+COMPARE_READERS = {name: BasicVersionedReader(version) for name, version, _ in PRESET_CONFIGS} if COMPARE else {}
+# Configuration name -> how many times the user picked its passage
+COMPARE_WINS = Counter()
+# Trim the context so that the prompt and completion fit the model
+TOKEN_BUDGET = TokenBudget(max_tokens=PASSAGE_PARAMS['max_tokens'])
 
 STORY_TITLE, BY = (None, None)
 
-def generate(original_title, context=''):
+# Generation failures that leave the title on the to do list rather than ending the session
+GENERATION_ERRORS = (BackendError, CircuitOpenError)
+
+# Titles we have asked the model for this session. Asking again means the last passage was rejected, so we want a fresh
+# sample rather than the cached one.
+ATTEMPTED_TITLES = set()
+
+def generate(original_title, context='', stream=False, alternates=None):
+    """
+    :param stream: print the passage as it is generated
+    :param alternates: a list to add the candidate passages that weren't picked to, best first, if the caller will
+        offer them
+    """
+    print('generating for title: ' + original_title)
+
+    title_to_save, prompt = make_generation_prompt(original_title, context=context)
+    use_cache = use_cache_for(original_title)
+    if GEN_CANDIDATES > 1:
+        completions = generator.get_candidates(prompt, GEN_CANDIDATES, use_cache=use_cache)
+        candidates = [title_to_save + '\n' + utils.gen_to_twee_format_3(completion) for completion in completions]
+        ranked = utils.rank_candidates(candidates)
+        if alternates is not None:
+            alternates += ranked[1:]
+        return ranked[0]
+    if stream:
+        completion = show_stream(generator.stream_completion(prompt, use_cache=use_cache))
+    else:
+        completion = generator.get_completion(prompt, use_cache=use_cache)
+
+    # Process the generated completion back into plain twee
+    twee_passage = title_to_save + '\n' + utils.gen_to_twee_format_3(completion)
+    return twee_passage
+
+
+def generate_for_interaction(passage_title, context, link_to_parent, speculator=None):
+    """
+    Generate a passage for the (g) command: compare the configurations, take a speculated passage, or generate one
+    (showing it as it streams), then let the user pick from the alternates, if there are any.
+    """
+    if COMPARE:
+        return choose_comparison(passage_title, generate_comparison(passage_title, link_to_parent))
+    alternates = []
+    passage = speculator.take(passage_title, context) if speculator else None
+    if passage:
+        ATTEMPTED_TITLES.add(passage_title)
+        print(f'completed passage: {italic(passage)} \n')
+    else:
+        passage = generate(passage_title, context=context, stream=STREAM, alternates=alternates)
+        if not STREAM or GEN_CANDIDATES > 1:
+            print(f'completed passage: {italic(passage)} \n')
+    if alternates:
+        passage = choose_alternate(passage, alternates)
+    return passage
+
+
+def generate_batch(original_titles, contexts):
+    """
+    Generate several passages with one batched request.
+    :return: the passages, in the same order as the titles
+    """
+    if len(original_titles) == 1 or GEN_CANDIDATES > 1:
+        return [generate(title, context=context) for title, context in zip(original_titles, contexts)]
+    print('generating for titles: ' + ', '.join(original_titles))
+
+    titles_to_save, prompts = zip(*[
+        make_generation_prompt(title, context=context) for title, context in zip(original_titles, contexts)
+    ])
+    use_cache = [use_cache_for(title) for title in original_titles]
+    completions = generator.get_completions(list(prompts), use_cache=use_cache)
+
+    return [
+        title_to_save + '\n' + utils.gen_to_twee_format_3(completion)
+        for title_to_save, completion in zip(titles_to_save, completions)
+    ]
+
+
+def generate_comparison(original_title, link_to_parent):
+    """
+    Generate a passage for the title with each of the preset configurations at once.
+    :return: a list of (configuration name, passage), in the order of PRESET_CONFIGS
+    """
+    use_cache = use_cache_for(original_title)
+
+    def generate_with(name):
+        context = make_context_for_interaction(original_title, link_to_parent, reader=COMPARE_READERS[name])
+        title_to_save, prompt = make_generation_prompt(original_title, context=context)
+        completion = COMPARE_GENERATORS[name].get_completion(prompt, use_cache=use_cache)
+        return title_to_save + '\n' + utils.gen_to_twee_format_3(completion)
+
     print('generating for title: ' + original_title)
+    names = [name for name, _, _ in PRESET_CONFIGS]
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        return list(zip(names, executor.map(generate_with, names)))
 
+
+def choose_comparison(title, comparison):
+    """
+    Show the passage each configuration generated and let the user pick one.
+    :return: the passage they pick
+    """
+    for i, (name, passage) in enumerate(comparison):
+        print(f'({i + 1}) {bold(name)}: {italic(passage)} \n')
+    choice = None
+    while choice not in range(len(comparison)):
+        choice = parse_gen_num(input(f'pick a passage (1-{len(comparison)}): ').split())
+        choice = choice - 1 if choice is not None else None
+    name, passage = comparison[choice]
+    COMPARE_WINS[name] += 1
+    logging.info(f"Compared\t{title}\t{name} won")
+    return passage
+
+
+def make_generation_prompt(original_title, context=''):
+    """
+    :return: (the title to save the passage under, the prompt to generate it from)
+    """
     title_to_save = utils.make_title(original_title, process=False)  # readable by twee
     processed_title = utils.make_title(original_title, process=True)  # ready for GPT-3
     prompt = utils.make_prompt(processed_title, context=context)
@@ -47,11 +203,66 @@ def generate(original_title, context=''):
         print(f'title {processed_title}')
         print(f'prompt {prompt}')
 
-    completion = generator.get_completion(prompt)
+    return title_to_save, prompt
 
-    # Process the generated completion back into plain twee
-    twee_passage = title_to_save + '\n' + utils.gen_to_twee_format_3(completion)
-    return twee_passage
+
+def use_cache_for(original_title):
+    """
+    Only the first attempt at a title may be served from the completion cache.
+    """
+    use_cache = original_title not in ATTEMPTED_TITLES
+    ATTEMPTED_TITLES.add(original_title)
+    return use_cache
+
+
+def speculate_passage(original_title, context=''):
+    """
+    Quietly generate a passage in the background. The title only counts as attempted once the user takes the passage,
+    so if they never do (eg they use (f) instead), the completion is served from the cache when it is asked for.
+    """
+    title_to_save, prompt = make_generation_prompt(original_title, context=context)
+    completion = background_generator.get_completion(prompt, use_cache=original_title not in ATTEMPTED_TITLES)
+    return title_to_save + '\n' + utils.gen_to_twee_format_3(completion)
+
+
+def speculate_next(speculator, links_to_do, link_to_parent):
+    """
+    Start generating the passages the user is most likely to pick next: the most recently added links,
+    ie those from the passage that was just written.
+    """
+    for title in reversed(links_to_do[-speculator.max_in_flight:]):
+        speculator.speculate(title, make_context_for_interaction(title, link_to_parent))
+
+
+def show_stream(chunks):
+    """
+    Print a completion as it streams in, then the links it made.
+    :return: the full completion
+    """
+    passage_stream = utils.PassageStream()
+    shown = 0
+    print(italic_start, end='')
+    for chunk in chunks:
+        passage_stream.feed(chunk)
+        readable = passage_stream.readable_twee()
+        print(readable[shown:], end='', flush=True)
+        shown = len(readable)
+    print(italic_end)
+    print(f"links: {', '.join(passage_stream.links) if passage_stream.links else 'None'}\n")
+    return passage_stream.text
+
+
+def choose_alternate(passage, alternates):
+    """
+    Let the user cycle through the alternate passages generated for a title.
+    :return: the passage they settle on
+    """
+    options = [passage] + alternates
+    i = 0
+    while input(f'(a) to see an alternate passage, enter to accept: ').lower().startswith('a'):
+        i = (i + 1) % len(options)
+        print(f'passage {i + 1} of {len(options)}: {italic(options[i])} \n')
+    return options[i]
 
 
 def get_command(title):
@@ -111,6 +322,14 @@ def retrospective(raw_passage, passages, title, links_to_do, links_done, link_to
     # Even the raw passage should have invalid characters removed for use in the linguistic analysis
     raw_passage = passage = utils.remove_invalid_chars_from_passage(raw_passage)
 
+    # Fixing an invalid passage locally is much cheaper than generating it again
+    if not utils.is_valid_passage(raw_passage):
+        repaired = utils.repair_passage(raw_passage, title=title)
+        if repaired:
+            print('Repaired invalid twee.')
+            logging.info(f"Repaired\t{title}")
+            raw_passage = passage = repaired
+
     if utils.is_valid_passage(raw_passage):
         passage = utils.lower_case_links(raw_passage)
         links = utils.get_links(passage)
@@ -203,10 +422,20 @@ def run_twee_file(filename):
             continue
 
 
-def make_context_for_interaction(passage_title, link_to_parent):
+def make_context_for_interaction(passage_title, link_to_parent, reader=None):
+    """
+    :param reader: the reader to write the context with, defaults to PassageTree.reader
+    """
+    reader = reader if reader else PassageTree.reader
     parent = link_to_parent[passage_title]
-    context_components = PassageTree.construct_context(parent)
-    context = PassageTree.reader.write_context_text(context_components)
+    context_components = PassageTree.construct_context(parent, title=passage_title)
+    sections = reader.write_context_sections(context_components)
+
+    title = utils.make_title(passage_title, process=True)
+    sections, usage = TOKEN_BUDGET.fit(sections, fixed_text=utils.make_prompt(title, context=' '))
+    logging.info(f"Prompt tokens for {title}\t{dict(usage)}")
+
+    context = ' '.join(sections.values())
     return context
 
 
@@ -232,8 +461,11 @@ def interactive():
     links_to_do = [start]
     links_done = set()
     link_to_parent = {start: None}
+    speculator = Speculator(speculate_passage, SPECULATION_IN_FLIGHT, SPECULATION_KEPT) if SPECULATE else None
     while links_to_do:
         print('To Do List:', links_to_do)
+        if speculator:
+            speculate_next(speculator, links_to_do, link_to_parent)
         if len(links_to_do) == 1:
             passage_title = links_to_do.pop()
         else:
@@ -245,9 +477,15 @@ def interactive():
 
         # Single title commands
         if command == 'g':
-            passage = generate(passage_title, context=context)
-            print(f'completed passage: {italic(passage)} \n')
+            try:
+                passage = generate_for_interaction(passage_title, context, link_to_parent, speculator)
+            except GENERATION_ERRORS as e:
+                print(f"Couldn't generate {passage_title} ({e}), it's back on the to do list.")
+                links_to_do.append(passage_title)
+                continue
         elif command == 'w':
+            if speculator:
+                speculator.discard(passage_title)
             clear(f'{bold(passage_title)}\n')
             passage = human_writes(passage_title)
         # Commands not utilizing the popped title
@@ -274,26 +512,83 @@ def interactive():
             passage, passages, passage_title, links_to_do, links_done, link_to_parent, compute_context=USE_CONTEXT
         )
 
+    if speculator:
+        print(speculator)
+        speculator.shutdown()
+    logging.info(f"Repairs\t{dict(utils.REPAIR_STATS)}")
+    if BasicVersionedReader.element_cache is not None:
+        logging.info(f"Narrative element cache\t{BasicVersionedReader.element_cache.stats()}")
+    if COMPARE:
+        print('Passages picked:', dict(COMPARE_WINS))
+        logging.info(f"Passages picked\t{dict(COMPARE_WINS)}")
+    TwineGenerator.telemetry.export(make_file_base_name(STORY_TITLE, 'telemetry.json'),
+                                    make_file_base_name(STORY_TITLE, 'prom'))
     print('Done!')
     twee_file = make_twee_text_file(STORY_TITLE, BY, passages)
     run_twee_file(twee_file)
 
 
-def generate_n(passages, passage_title, links_to_do, links_done, link_to_parent, n=DEFAULT_GEN_COUNT):
+def generate_n(passages, passage_title, links_to_do, links_done, link_to_parent, n=DEFAULT_GEN_COUNT,
+               concurrency=GEN_CONCURRENCY, batch_size=GEN_BATCH_SIZE):
     """
     Generate n passages using the defined generator.
+
+    Sibling passages only depend on their (already written) parent, so up to `concurrency` requests, each for a batch
+    of up to `batch_size` titles, are kept in flight at once. Results are committed in the order their titles were taken
+    off the to do list, which is the same order the one-at-a-time version would produce them in.
+
+    Generation and analysis are pipelined: as soon as a batch comes back its slot is refilled, so the next requests are
+    in flight while retrospective runs the NLP on it. Links only join the to do list once their parent has been through
+    retrospective, so children always wait for their parent's context.
+
+    If a batch fails (see GENERATION_ERRORS), its titles go back on the to do list and no more batches are started.
     """
-    num_generated = 0
+    num_generated = num_submitted = 0
+    failed = False
     links_to_do.append(passage_title)  # We've already popped one but we want to generate it too
     n = min(n, MAX_GEN_COUNT)
-    while links_to_do and num_generated < n:
-        passage_title = links_to_do.pop(0)
-        context = make_context_for_interaction(passage_title, link_to_parent)
-        passage = generate(passage_title, context=context)
-        _, passages, links_to_do, links_done, link_to_parent = retrospective(
-            passage, passages, passage_title, links_to_do, links_done, link_to_parent, compute_context=USE_CONTEXT,
-        )
-        num_generated += 1
+    concurrency, batch_size = max(1, concurrency), max(1, batch_size)
+    in_flight = deque()  # (titles, parents, future) in the order they were submitted
+
+    def top_up(executor):
+        """
+        Fill the generation window with titles whose parents have already been written
+        """
+        nonlocal num_submitted
+        while not failed and links_to_do and len(in_flight) < concurrency and num_submitted < n:
+            titles = []
+            while links_to_do and len(titles) < batch_size and num_submitted < n:
+                titles.append(links_to_do.pop(0))
+                num_submitted += 1
+            contexts = [make_context_for_interaction(title, link_to_parent) for title in titles]
+            future = executor.submit(generate_batch, titles, contexts)
+            in_flight.append((titles, [link_to_parent[title] for title in titles], future))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while in_flight or (not failed and links_to_do and num_submitted < n):
+            top_up(executor)
+            titles, parents, future = in_flight.popleft()
+            try:
+                generated = future.result()
+            except GENERATION_ERRORS as e:
+                print(f"Couldn't generate {', '.join(titles)} ({e}), they're back on the to do list.")
+                failed = True
+                links_to_do = titles + links_to_do
+                link_to_parent.update(zip(titles, parents))
+                continue
+            # Keep the network busy while this batch is analysed
+            top_up(executor)
+            for i, (passage_title, parent, passage) in enumerate(zip(titles, parents, generated)):
+                # A passage committed while this one was in flight may have linked to it, keep the parent we generated with
+                link_to_parent[passage_title] = parent
+                _, passages, links_to_do, links_done, link_to_parent = retrospective(
+                    passage, passages, passage_title, links_to_do, links_done, link_to_parent, compute_context=USE_CONTEXT,
+                )
+                # Don't queue titles a second time while they are still being generated
+                pending = set(titles[i + 1:]) | {title for batch, _, _ in in_flight for title in batch}
+                links_to_do = [link for link in links_to_do if link not in pending]
+                num_generated += 1
+
     hit_max = f'(hit maximum of {n})' if num_generated == n else ''
     input(f"done generating {num_generated} passages {hit_max}")
     return passages, links_to_do, links_done, link_to_parent
@@ -330,5 +625,15 @@ def parse_gen_num(args):
         return None
 
 
+USAGE = """Usage: python src/spindle.py [1|2|3|compare]
+    1 - no context
+    2 - LOC and PER NER elements, pronouns
+    3 - All NER elements, pronouns, bulleted events (the default)
+    compare - generate each passage with every configuration and pick the best"""
+
+
 if __name__ == '__main__':
-    interactive()
+    if len(argv) > 1 and argv[1] in ('-h', '--help'):
+        print(USAGE)
+    else:
+        interactive()
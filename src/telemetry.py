@@ -0,0 +1,196 @@
+import bisect
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128]  # seconds
+TOKEN_BUCKETS = [16, 32, 64, 128, 256, 512, 1024, 2048, 4096]
+
+
+class Histogram:
+    def __init__(self, buckets):
+        """
+        A cumulative histogram in the Prometheus style: counts[i] is the number of observations <= buckets[i],
+        with a final +Inf bucket.
+        """
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: a list of (upper bound, number of observations <= the bound), the last bound being '+Inf'
+        """
+        total, result = 0, []
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def percentile(values, p):
+    """
+    The pth percentile (0-100) of values, by nearest rank.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+class Telemetry:
+    # Histogrammed fields of each call record
+    HISTOGRAMS = {
+        'latency': ('latency_seconds', LATENCY_BUCKETS, 'Wall clock time of each call'),
+        'prompt_tokens': ('prompt_tokens', TOKEN_BUCKETS, 'Tokens in the prompt of each call'),
+        'completion_tokens': ('completion_tokens', TOKEN_BUCKETS, 'Tokens in the completion of each call'),
+    }
+
+    def __init__(self, prefix='spindle_completion'):
+        """
+        Record the latency, token counts, retries, rate limit waits and cache status of every model call,
+        grouped by the kind of call (passage, summary...), and export them at the end of a session.
+
+        :param prefix: the prefix of the exported Prometheus metric names
+        """
+        self.prefix = prefix
+        self.records = []
+        self._histograms = defaultdict(dict)  # kind -> field -> Histogram
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'<Telemetry {len(self.records)} calls>'
+
+    @contextmanager
+    def call(self, kind, model):
+        """
+        Time a call. The caller fills in what it knows about the call in the yielded record:
+        cache ('hit', 'miss' or 'skip'), prompt_tokens, completion_tokens, retries, rate_limit_wait and backoff_wait.
+        """
+        record = {
+            'kind': kind,
+            'model': model,
+            'cache': 'skip',
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            'retries': 0,
+            'rate_limit_wait': 0.,
+            'backoff_wait': 0.,
+            'error': None,
+        }
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            record['latency'] = time.perf_counter() - start
+            self.add(record)
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+            for field, (_, buckets, _) in Telemetry.HISTOGRAMS.items():
+                if field not in self._histograms[record['kind']]:
+                    self._histograms[record['kind']][field] = Histogram(buckets)
+                self._histograms[record['kind']][field].observe(record[field])
+
+    def summary(self):
+        """
+        :return: a dict mapping each kind of call to its counts, latency percentiles, token totals, retries,
+            waits and histograms
+        """
+        with self._lock:
+            records = list(self.records)
+            histograms = {kind: dict(fields) for kind, fields in self._histograms.items()}
+
+        by_kind = defaultdict(list)
+        for record in records:
+            by_kind[record['kind']].append(record)
+
+        summary = {}
+        for kind, kind_records in by_kind.items():
+            latencies = [r['latency'] for r in kind_records]
+            summary[kind] = {
+                'calls': len(kind_records),
+                'errors': sum(bool(r['error']) for r in kind_records),
+                'cache': {status: sum(r['cache'] == status for r in kind_records) for status in ('hit', 'miss', 'skip')},
+                'latency': {
+                    'mean': sum(latencies) / len(latencies),
+                    'p50': percentile(latencies, 50),
+                    'p90': percentile(latencies, 90),
+                    'p99': percentile(latencies, 99),
+                    'max': max(latencies),
+                },
+                'prompt_tokens': sum(r['prompt_tokens'] for r in kind_records),
+                'completion_tokens': sum(r['completion_tokens'] for r in kind_records),
+                'retries': sum(r['retries'] for r in kind_records),
+                'rate_limit_wait': sum(r['rate_limit_wait'] for r in kind_records),
+                'backoff_wait': sum(r['backoff_wait'] for r in kind_records),
+                'histograms': {
+                    field: {
+                        'buckets': [[bound, count] for bound, count in histogram.cumulative()],
+                        'sum': histogram.sum,
+                        'count': histogram.count,
+                    }
+                    for field, histogram in histograms[kind].items()
+                },
+            }
+        return summary
+
+    def to_prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        summary = self.summary()
+        lines = []
+
+        for field, (name, _, description) in Telemetry.HISTOGRAMS.items():
+            metric = f'{self.prefix}_{name}'
+            lines += [f'# HELP {metric} {description}.', f'# TYPE {metric} histogram']
+            for kind, kind_summary in summary.items():
+                histogram = kind_summary['histograms'][field]
+                for bound, count in histogram['buckets']:
+                    lines.append(f'{metric}_bucket{{kind="{kind}",le="{bound}"}} {count}')
+                lines.append(f'{metric}_sum{{kind="{kind}"}} {histogram["sum"]}')
+                lines.append(f'{metric}_count{{kind="{kind}"}} {histogram["count"]}')
+
+        counters = [
+            ('calls_total', 'Calls, by cache status', lambda s: s['cache'], 'cache'),
+            ('errors_total', 'Calls that failed', lambda s: s['errors'], None),
+            ('retries_total', 'Retried requests', lambda s: s['retries'], None),
+            ('rate_limit_wait_seconds_total', 'Time spent waiting on the client side rate limiter',
+             lambda s: s['rate_limit_wait'], None),
+            ('backoff_wait_seconds_total', 'Time spent backing off before retries', lambda s: s['backoff_wait'], None),
+        ]
+        for name, description, value, label in counters:
+            metric = f'{self.prefix}_{name}'
+            lines += [f'# HELP {metric} {description}.', f'# TYPE {metric} counter']
+            for kind, kind_summary in summary.items():
+                if label:
+                    for label_value, count in value(kind_summary).items():
+                        lines.append(f'{metric}{{kind="{kind}",{label}="{label_value}"}} {count}')
+                else:
+                    lines.append(f'{metric}{{kind="{kind}"}} {value(kind_summary)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, json_path=None, prometheus_path=None):
+        """
+        Write the summary as json and/or the metrics as a Prometheus text file.
+        """
+        if json_path:
+            with open(json_path, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
+        if prometheus_path:
+            with open(prometheus_path, 'w') as f:
+                f.write(self.to_prometheus())
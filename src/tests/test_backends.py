@@ -0,0 +1,45 @@
+import unittest
+from backends import HTTPBackend, BackendError, get_backend, BACKENDS
+from local_server import serve
+import twee_utils as utils
+
+
+class TestHTTPBackend(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = serve(port=0, block=False)
+        cls.backend = HTTPBackend(base_url=f'http://localhost:{cls.server.server_port}/v1')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.backend.close()
+        cls.server.shutdown()
+
+    def test_completion_format(self):
+        response = self.backend.complete('a model', '<|begin|>:: start<|start|>', max_tokens=1000, stop=utils.END)
+        self.assertEqual(len(response['choices']), 1)
+        text = response['choices'][0]['text']
+        self.assertNotIn(utils.END, text)
+        self.assertTrue(utils.get_links(text))
+
+    def test_choices_for_each_prompt(self):
+        response = self.backend.complete('a model', ['first', 'second'], n=2)
+        self.assertEqual([c['index'] for c in response['choices']], [0, 1, 2, 3])
+
+    def test_stream(self):
+        chunks = list(self.backend.stream('a model', '<|begin|>:: start<|start|>', stop=utils.END))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(utils.get_links(''.join(chunks)))
+
+    def test_connection_errors_are_retryable(self):
+        backend = HTTPBackend(base_url='http://localhost:1/v1', connect_timeout=0.5)
+        self.assertRaises(BackendError, backend.complete, 'a model', 'prompt')
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_get_backend(self):
+        self.assertIn('openai', BACKENDS)
+        self.assertIsInstance(get_backend('http', base_url='http://localhost:8000/v1'), HTTPBackend)
+        self.assertRaises(ValueError, get_backend, 'nope')
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+from backends import CompletionBackend
+from cassette import RecordingBackend, ReplayBackend, CassetteMissError
+from disk_cache import DiskCache
+from external_model import TwineGenerator
+
+
+class CountingBackend(CompletionBackend):
+    def __init__(self):
+        self.calls = 0
+
+    def complete(self, model, prompt, **params):
+        self.calls += 1
+        return {'choices': [{'text': f'{prompt} {self.calls}', 'index': 0}]}
+
+
+class TestCassette(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, 'session.jsonl')
+
+    def test_record_and_replay(self):
+        recorder = RecordingBackend(self.path, CountingBackend())
+        first = recorder.complete('model', 'prompt', temperature=0.7)
+        second = recorder.complete('model', 'prompt', temperature=0.7)
+        streamed = list(recorder.stream('model', 'another prompt', temperature=0.7))
+
+        player = ReplayBackend(self.path)
+        self.assertEqual(player.complete('model', 'prompt', temperature=0.7), first)
+        self.assertEqual(player.complete('model', 'prompt', temperature=0.7), second)
+        self.assertEqual(player.complete('model', 'prompt', temperature=0.7), second)  # the last one repeats
+        self.assertEqual(list(player.stream('model', 'another prompt', temperature=0.7)), streamed)
+
+    def test_unrecorded_request(self):
+        RecordingBackend(self.path, CountingBackend()).complete('model', 'prompt', temperature=0.7)
+        player = ReplayBackend(self.path)
+        self.assertRaises(CassetteMissError, player.complete, 'model', 'prompt', temperature=1)
+
+    def test_streams_stopped_early_are_recorded(self):
+        recorder = RecordingBackend(self.path, CountingBackend())
+        chunks = recorder.stream('model', 'prompt', temperature=0.7)
+        first = next(chunks)
+        chunks.close()
+        player = ReplayBackend(self.path)
+        self.assertEqual(list(player.stream('model', 'prompt', temperature=0.7)), [first])
+
+    def test_generators_share_a_cassette(self):
+        TwineGenerator.cache = DiskCache(':memory:')
+        recording = TwineGenerator('naive', verbose=False, backend=CountingBackend(), record=self.path)
+        background = TwineGenerator('naive', verbose=False, backend=recording.backend, record=self.path)
+        self.assertIs(background.backend, recording.backend)
+        first, second = recording.get_completion('prompt'), background.get_completion('prompt')
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        replaying = [TwineGenerator('naive', verbose=False, replay=self.path) for _ in range(2)]
+        self.assertIs(replaying[0].backend, replaying[1].backend)
+        self.assertEqual([g.get_completion('prompt') for g in replaying], [first, second])
+        TwineGenerator.replay_backends.pop(self.path)
@@ -0,0 +1,134 @@
+import pickle
+import unittest
+from unittest import mock
+from types import SimpleNamespace
+from contextual_tree import PassageTree
+from disk_cache import DiskCache
+from narrative_reader import BasicVersionedReader, EventToken, make_event
+
+TWEE = """:: Start
+You wake up. [[Open the door|door]] or [[look outside|window]].
+
+:: door
+The door is locked. [[window]]
+
+:: window
+Rain.
+"""
+
+
+class CountingReader(BasicVersionedReader):
+    """
+    Pretends to extract each passage's text as a pronoun, counting how many batches it was asked for.
+    """
+
+    def __init__(self):
+        super().__init__(1.2, use_daemon=False)
+        self.batches = []
+
+    def make_many_context_components(self, passage_texts, batch_size=32):
+        self.batches.append(list(passage_texts))
+        return [{'v': 1.2, 'pronouns': [text], 'entities': {}} for text in passage_texts]
+
+
+class ExtractingReader(BasicVersionedReader):
+    """
+    Pretends to run the models, keeping every text it was asked to read.
+    """
+
+    def __init__(self):
+        super().__init__(1.2, use_daemon=False)
+        self.read = []
+
+    def _extract_many(self, passage_texts, batch_size=32):
+        self.read += passage_texts
+        return [{'v': 1.2, 'pronouns': [text], 'entities': {}} for text in passage_texts]
+
+
+class TestPassageTree(unittest.TestCase):
+
+    def setUp(self):
+        self.reader, self.context_mode = PassageTree.reader, PassageTree.context_mode
+        PassageTree.reader = CountingReader()
+
+    def tearDown(self):
+        PassageTree.reader, PassageTree.context_mode = self.reader, self.context_mode
+        PassageTree.summarizer = None
+
+    def test_create_extracts_in_one_batch(self):
+        root, _ = PassageTree.create(twee=TWEE)
+        self.assertEqual(len(PassageTree.reader.batches), 1)
+        # Passages are visited depth first, so the window is reached through the door
+        door, = root.children
+        self.assertEqual([door.title, door.children[0].title], [':: door', ':: window'])
+        self.assertEqual(door.narrative_elements['pronouns'], [door.cleaned_passage_text])
+        self.assertEqual(door.full_context, [root.narrative_elements])
+
+    def test_summary_context(self):
+        PassageTree.context_mode = 'summary'
+        PassageTree.summarizer = lambda text: f'summary of {text.split()[-1]}'
+        root, _ = PassageTree.create(twee=TWEE)
+        door, = root.children
+        self.assertEqual(door.full_context[0]['summary'], root.get_rolling_summary())
+        self.assertEqual(door.get_rolling_summary(), 'summary of window')
+
+    def test_rolling_summaries_build_on_each_other(self):
+        PassageTree.context_mode = 'summary'
+        stories = []
+        PassageTree.summarizer = lambda story: stories.append(story) or f'summary {len(stories)}'
+        root, _ = PassageTree.create(twee=TWEE)
+        window = root.children[0].children[0]
+        self.assertEqual(window.get_rolling_summary(), 'summary 3')
+        self.assertEqual(stories[1:], ['summary 1 The door is locked. window', 'summary 2 Rain.'])
+
+    def test_tree_with_events_pickles(self):
+        root, _ = PassageTree.create(twee=TWEE)
+        # eg tokens from textacy's triples
+        words = [SimpleNamespace(text=text, lemma_=text.lower()) for text in ['Anna', 'knits', 'socks']]
+        root.narrative_elements['events'] = [make_event([[word] for word in words])]
+        self.assertEqual(root.narrative_elements['events'][0][1], (EventToken('knits', 'knits'),))
+        self.assertIs(root.convert_events_to_fake_token(), root.narrative_elements['events'])
+        copy = pickle.loads(pickle.dumps(root))
+        self.assertEqual(copy.narrative_elements, root.narrative_elements)
+        self.assertEqual([n.title for n in copy.descendants], [':: door', ':: window'])
+
+
+class TestElementCache(unittest.TestCase):
+
+    def setUp(self):
+        self.reader, self.cache = PassageTree.reader, BasicVersionedReader.element_cache
+        PassageTree.reader = ExtractingReader()
+        BasicVersionedReader.element_cache = DiskCache(':memory:', max_entries=None)
+
+    def tearDown(self):
+        PassageTree.reader, BasicVersionedReader.element_cache = self.reader, self.cache
+
+    def test_unchanged_passages_are_read_once(self):
+        root, _ = PassageTree.create(twee=TWEE)
+        self.assertEqual(len(PassageTree.reader.read), 3)
+        again, _ = PassageTree.create(twee=TWEE.replace('Rain.', 'Snow.'))
+        self.assertEqual(PassageTree.reader.read[3:], ['Snow.'])
+        self.assertEqual(again.narrative_elements, root.narrative_elements)
+        self.assertAlmostEqual(BasicVersionedReader.element_cache.stats()['hit_rate'], 2 / 6)
+
+    def test_a_batch_is_cached_in_one_write(self):
+        cache = BasicVersionedReader.element_cache
+        with mock.patch.object(cache, 'set_many', wraps=cache.set_many) as set_many:
+            PassageTree.create(twee=TWEE)
+        self.assertEqual(set_many.call_count, 1)
+        self.assertEqual(len(cache), 3)
+
+    def test_repeated_passages_are_read_once(self):
+        reader = PassageTree.reader
+        placeholders = reader.make_many_context_components(['Not written yet.'] * 3)
+        self.assertEqual(reader.read, ['Not written yet.'])
+        placeholders[0]['summary'] = 'nothing'
+        self.assertNotIn('summary', placeholders[1])
+        reader.make_context_components('Not written yet.')
+        self.assertEqual(len(reader.read), 1)
+
+    def test_key_depends_on_version(self):
+        reader = PassageTree.reader
+        key = reader._cache_key('Rain.')
+        reader.extraction_version = 1.3
+        self.assertNotEqual(reader._cache_key('Rain.'), key)
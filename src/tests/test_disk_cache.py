@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+from disk_cache import DiskCache, hash_key
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = DiskCache(':memory:', max_entries=3)
+
+    def test_get_and_set(self):
+        self.assertIsNone(self.cache.get('missing'))
+        self.cache.set('key', {'text': 'a passage'})
+        self.assertEqual(self.cache.get('key'), {'text': 'a passage'})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        for key in 'abc':
+            self.cache.set(key, key)
+        self.cache.get('a')  # a is now more recently used than b
+        self.cache.set('d', 'd')
+        self.assertEqual(len(self.cache), 3)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('a', self.cache)
+
+    def test_evict_by_bytes(self):
+        cache = DiskCache(':memory:', max_entries=None, max_bytes=10)
+        cache.set('a', 'aaaaaa')
+        cache.set('b', 'bbbbbb')
+        self.assertEqual(len(cache), 1)
+        self.assertIn('b', cache)
+
+    def test_hash_key_depends_on_every_part(self):
+        params = {'temperature': 0.7, 'max_tokens': 1000}
+        key = hash_key('prompt', 'model', params)
+        self.assertEqual(key, hash_key('prompt', 'model', dict(reversed(list(params.items())))))
+        self.assertNotEqual(key, hash_key('prompt', 'other model', params))
+        self.assertNotEqual(key, hash_key('prompt', 'model', {**params, 'temperature': 1}))
+
+    def test_evict_many_by_bytes(self):
+        # More entries than sqlite allows variables in one statement
+        cache = DiskCache(':memory:', max_entries=None, max_bytes=4 * 20000)
+        cache.set_many((str(i), 'ab') for i in range(40000))
+        self.assertEqual(len(cache), 20000)
+        self.assertIn('39999', cache)
+        self.assertNotIn('0', cache)
+
+    def test_counts_survive_reopening(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cache.sqlite3')
+        cache = DiskCache(path)
+        cache.set_many([('a', 'aa'), ('b', 'bb'), ('a', 'a')])
+        cache.get('b')
+        cache.close()
+        reopened = DiskCache(path, max_entries=1)
+        self.assertEqual(len(reopened), 2)
+        reopened.evict()
+        # b was read after a was last written
+        self.assertEqual((len(reopened), 'b' in reopened), (1, True))
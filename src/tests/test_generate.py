@@ -1,5 +1,16 @@
 from parameterized import parameterized, parameterized_class  # https://github.com/wolever/parameterized
+import time
 import unittest
+from unittest import mock
+import external_model
+from backends import BackendError, HTTPBackend, RateLimitedError
+from disk_cache import DiskCache
+from external_model import TwineGenerator
+from hedging import Hedger
+from rate_limit import CircuitBreaker, RetryBudget, TokenBucket
+from local_server import serve
+from telemetry import Telemetry
+from simulation import SimulatedBackend
 
 
 class TestValidTwee(unittest.TestCase):
@@ -16,3 +27,164 @@ class TestValidTwee(unittest.TestCase):
             True
         )
 
+
+class TestTwineGenerator(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = serve(port=0, block=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        TwineGenerator.cache = DiskCache(':memory:')
+        TwineGenerator.summary_cache = DiskCache(':memory:')
+        TwineGenerator.telemetry = Telemetry()
+        self.backend = HTTPBackend(base_url=f'http://localhost:{self.server.server_port}/v1')
+        self.generator = TwineGenerator('events', verbose=False, backend=self.backend)
+        self.requests = []
+        complete = self.backend.complete
+        self.backend.complete = lambda model, prompt, **params: self.requests.append(prompt) or complete(model, prompt, **params)
+
+    def test_cached_prompts_are_not_requested(self):
+        completion = self.generator.get_completion('<|begin|>:: start<|start|>')
+        self.assertEqual(self.generator.get_completion('<|begin|>:: start<|start|>'), completion)
+        self.assertEqual(len(self.requests), 1)
+        self.generator.get_completion('<|begin|>:: start<|start|>', use_cache=False)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_candidates_in_one_request(self):
+        candidates = self.generator.get_candidates('first', 3)
+        self.assertEqual(len(candidates), 3)
+        self.assertEqual(self.generator.get_candidates('first', 3), candidates)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_batched_completions(self):
+        first = self.generator.get_completion('first')
+        completions = self.generator.get_completions(['first', 'second', 'third'])
+        self.assertEqual(completions[0], first)
+        self.assertEqual(self.requests, ['first', ['second', 'third']])
+
+    def test_batch_missing_choices_are_completed_one_at_a_time(self):
+        complete = self.backend.complete
+
+        def drop_last_choice(model, prompt, **params):
+            response = complete(model, prompt, **params)
+            if isinstance(prompt, list):
+                response['choices'] = response['choices'][:-1]
+            return response
+        self.backend.complete = drop_last_choice
+        completions = self.generator.get_completions(['first', 'second', 'third'])
+        self.assertTrue(all(completions))
+        self.assertEqual(self.requests, [['first', 'second', 'third'], 'third'])
+
+    def test_failed_batch_is_completed_one_at_a_time(self):
+        complete = self.backend.complete
+
+        def fail_batches(model, prompt, **params):
+            if isinstance(prompt, list):
+                raise BackendError('batch failed')
+            return complete(model, prompt, **params)
+        self.backend.complete = fail_batches
+        with mock.patch.object(external_model, 'MAX_RETRIES', 0):
+            completions = self.generator.get_completions(['first', 'second'])
+        self.assertTrue(all(completions))
+        # The failed batch never reached the server
+        self.assertEqual(self.requests, ['first', 'second'])
+
+    def test_summarize_many_dedupes(self):
+        summaries = self.generator.summarize_many(['You open [[the door]]', 'You open the door', 'You wait'])
+        self.assertEqual(len(summaries), 3)
+        self.assertEqual(summaries[0], summaries[1])
+        self.assertEqual(len(self.requests), 2)
+        self.generator.summarize_many(['You wait'])
+        self.assertEqual(len(self.requests), 2)
+
+    def test_summaries_are_only_cached_once_per_backend(self):
+        self.generator.summarize('You wait')
+        self.assertEqual((len(TwineGenerator.summary_cache), len(TwineGenerator.cache)), (1, 0))
+        simulated = TwineGenerator('events', verbose=False, backend=SimulatedBackend(mean_latency=0, seed=0))
+        simulated.summarize('You wait')
+        self.assertEqual(len(TwineGenerator.summary_cache), 2)
+        uncached = TwineGenerator('events', verbose=False, use_cache=False, backend=self.backend)
+        uncached.summarize('You rest')
+        self.assertEqual(len(TwineGenerator.summary_cache), 2)
+
+    def test_story_summaries_run_past_the_first_sentence(self):
+        params = []
+        complete = self.backend.complete
+        self.backend.complete = lambda model, prompt, **kwargs: params.append(kwargs) or complete(model, prompt, **kwargs)
+        self.generator.summarize_story('You wake up. You open the door.')
+        self.assertNotEqual(params[0]['stop'], '.')
+        self.assertEqual(len(TwineGenerator.summary_cache), 1)
+
+    def test_telemetry(self):
+        self.generator.get_completion('first')
+        self.generator.get_completion('first')
+        self.generator.summarize('You wait')
+        summary = TwineGenerator.telemetry.summary()
+        self.assertEqual(summary['passage']['calls'], 2)
+        self.assertEqual(summary['passage']['cache'], {'hit': 1, 'miss': 1, 'skip': 0})
+        self.assertGreater(summary['passage']['prompt_tokens'], 0)
+        self.assertGreater(summary['passage']['completion_tokens'], 0)
+        self.assertEqual(summary['summary']['calls'], 1)
+
+    def test_hedged_telemetry_is_the_winners(self):
+        complete, calls = self.backend.complete, []
+
+        def fail_then_slow(model, prompt, **params):
+            calls.append(prompt)
+            if len(calls) == 1:
+                raise BackendError('try again')
+            if len(calls) == 2:
+                time.sleep(0.3)
+            return complete(model, prompt, **params)
+        self.backend.complete = fail_then_slow
+        hedger = Hedger(percentile=50, min_samples=1)
+        hedger.observe(0.05)
+        generator = TwineGenerator('events', verbose=False, use_cache=False, backend=self.backend, hedge=True)
+        with mock.patch.object(TwineGenerator, 'hedger', hedger), \
+                mock.patch.object(TwineGenerator, 'rate_limiter', TokenBucket(100)), \
+                mock.patch.object(external_model, 'RETRY_BASE_DELAY', 0):
+            generator.get_completion('first')
+        hedger.shutdown()
+        # The primary retried, but the hedge answered first
+        self.assertEqual(hedger.hedge_wins, 1)
+        self.assertEqual(TwineGenerator.telemetry.summary()['passage']['retries'], 0)
+
+    def test_rate_limits_dont_open_the_circuit(self):
+        complete, calls = self.backend.complete, []
+
+        def rate_limited(model, prompt, **params):
+            calls.append(prompt)
+            if len(calls) <= 3:
+                raise RateLimitedError('slow down')
+            return complete(model, prompt, **params)
+        self.backend.complete = rate_limited
+        breaker = CircuitBreaker(failure_threshold=2)
+        with mock.patch.object(TwineGenerator, 'circuit_breaker', breaker), \
+                mock.patch.object(TwineGenerator, 'rate_limiter', TokenBucket(100)), \
+                mock.patch.object(TwineGenerator, 'retry_budget', RetryBudget()), \
+                mock.patch.object(external_model, 'RETRY_BASE_DELAY', 0):
+            self.assertTrue(self.generator.get_completion('first'))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_mock_is_simulated(self):
+        generator = TwineGenerator('mock', verbose=False, backend=SimulatedBackend(mean_latency=0, seed=0))
+        completion = generator.get_completion('<|begin|>:: start<|start|>')
+        self.assertIsInstance(completion, str)
+        self.assertEqual(len(generator.get_candidates('first', 2)), 2)
+        self.assertEqual(len(self.requests), 0)
+
+    def test_mock_is_never_cached(self):
+        TwineGenerator.cache = TwineGenerator.summary_cache = None
+        generator = TwineGenerator('mock', verbose=False, backend=SimulatedBackend(mean_latency=0, seed=0))
+        generator.get_completion('first')
+        generator.get_completions(['first', 'second'])
+        list(generator.stream_completion('first'))
+        generator.summarize('You wait')
+        # The caches were never even opened
+        self.assertIsNone(TwineGenerator.cache)
+        self.assertIsNone(TwineGenerator.summary_cache)
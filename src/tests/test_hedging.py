@@ -0,0 +1,59 @@
+import threading
+import time
+import unittest
+from hedging import Hedger
+
+
+class TestHedger(unittest.TestCase):
+
+    def setUp(self):
+        self.hedger = Hedger(percentile=50, min_samples=3)
+        for _ in range(3):
+            self.hedger.observe(0.01)
+
+    def tearDown(self):
+        self.hedger.shutdown()
+
+    def test_no_hedging_without_samples(self):
+        hedger = Hedger(min_samples=3)
+        self.assertIsNone(hedger.delay())
+        self.assertEqual(hedger.call(lambda: 'done'), 'done')
+        self.assertEqual(hedger.hedged, 0)
+        hedger.shutdown()
+
+    def test_slow_call_is_hedged(self):
+        calls = []
+
+        def slow_then_fast():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(1)
+                return 'slow'
+            return 'fast'
+
+        discarded = threading.Event()
+        start = time.perf_counter()
+        self.assertEqual(self.hedger.call(slow_then_fast, discard=lambda result: discarded.set()), 'fast')
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual((self.hedger.hedged, self.hedger.hedge_wins), (1, 1))
+        self.assertTrue(discarded.wait(2))
+
+    def test_failed_hedge_falls_back_to_primary(self):
+        calls = []
+
+        def slow_then_failing():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(0.1)
+                return 'slow'
+            raise ValueError()
+
+        self.assertEqual(self.hedger.call(slow_then_failing), 'slow')
+        self.assertEqual(self.hedger.hedge_wins, 0)
+
+    def test_both_failing_raises(self):
+        def failing():
+            time.sleep(0.05)
+            raise ValueError()
+
+        self.assertRaises(ValueError, self.hedger.call, failing)
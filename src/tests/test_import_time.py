@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+from parameterized import parameterized
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds each entry point may take to import. None of them should load the NLP models.
+IMPORT_BUDGETS = {
+    'twee_utils': 1.,
+    'narrative_reader': 1.,
+    'contextual_tree': 2.,
+    'external_model': 3.,
+    'spindle': 4.,
+}
+
+
+class TestImportTime(unittest.TestCase):
+
+    @parameterized.expand(IMPORT_BUDGETS.items())
+    def test_import_time(self, module, budget):
+        """
+        Import the module in a fresh interpreter, from another directory, so that nothing is already loaded.
+        """
+        code = (
+            'import sys, time\n'
+            'start = time.perf_counter()\n'
+            f'import {module}\n'
+            'print(time.perf_counter() - start)\n'
+            f'print(any(name in sys.modules for name in ("spacy", "transformers", "textacy")))\n'
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', code, '--help'], cwd=os.path.dirname(SRC_DIR),
+            env=dict(os.environ, PYTHONPATH=SRC_DIR), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if 'ModuleNotFoundError' in result.stderr:
+            self.skipTest(f'missing dependencies: {result.stderr.strip().splitlines()[-1]}')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        seconds, loaded_models = result.stdout.strip().splitlines()[-2:]
+        self.assertEqual(loaded_models, 'False')
+        self.assertLess(float(seconds), budget)
+
+
+class TestLazyModels(unittest.TestCase):
+
+    def test_module_attributes_load_the_models(self):
+        import narrative_reader
+        nlp, ner_pipeline = object(), object()
+        with mock.patch.object(narrative_reader, '_nlp', nlp), \
+                mock.patch.object(narrative_reader, '_ner_pipeline', ner_pipeline):
+            self.assertIs(narrative_reader.nlp, nlp)
+            self.assertIs(narrative_reader.ner_pipeline, ner_pipeline)
+        self.assertRaises(AttributeError, getattr, narrative_reader, 'not_a_model')
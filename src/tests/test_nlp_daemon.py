@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+from nlp_daemon import NLPClient, serve, encode_components, decode_components
+from narrative_reader import BasicVersionedReader, list_triples_author, make_event
+
+
+def fake_many_components(texts, version):
+    return [fake_components(text, version) for text in texts]
+
+
+def fake_components(text, version):
+    if text == 'fail':
+        raise ValueError('no')
+    return {
+        'v': version,
+        'pronouns': ['she'],
+        'entities': {'PER': [text]},
+        'events': [make_event([[('Anna', 'anna')], [('knits', 'knit')], [('socks', 'sock')]])],
+    }
+
+
+class TestNLPDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'nlp.sock')
+        self.server = serve(self.path, make_components=fake_many_components, block=False)
+        self.client = NLPClient(self.path)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        components = self.client.make_context_components('Anna', 1.3)
+        self.assertEqual(components, fake_components('Anna', 1.3))
+        self.assertEqual(list_triples_author(components['events']), 'Preceding Events:\n* anna knits socks\n')
+        # the connection is reused
+        self.assertEqual(self.client.make_context_components('Alex', 1.2)['entities'], {'PER': ['Alex']})
+
+    def test_many(self):
+        many_components = self.client.make_many_context_components(['Anna', 'Alex'], 1.3)
+        self.assertEqual(many_components, fake_many_components(['Anna', 'Alex'], 1.3))
+
+    def test_errors(self):
+        self.assertRaises(RuntimeError, self.client.make_context_components, 'fail', 1.3)
+        self.assertRaises(OSError, NLPClient(self.path + '.missing').make_context_components, 'Anna', 1.3)
+
+    def test_reader_uses_daemon(self):
+        reader = BasicVersionedReader(1.2, use_daemon=True, use_cache=False)
+        reader._client = self.client
+        self.assertEqual(reader.make_context_components('Anna')['entities'], {'PER': ['Anna']})
+
+    def test_only_sockets_are_replaced(self):
+        path = os.path.join(self.directory.name, 'not a socket')
+        with open(path, 'w') as f:
+            f.write('precious')
+        self.assertFalse(NLPClient(path).available())
+        self.assertRaises(FileExistsError, serve, path, fake_many_components, False)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'precious')
+        self.assertTrue(self.client.available())
+
+    def test_codec(self):
+        components = fake_components('Anna', 1.3)
+        self.assertEqual(decode_components(encode_components(components)), components)
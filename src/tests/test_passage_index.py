@@ -0,0 +1,30 @@
+import unittest
+import numpy as np
+from passage_index import PassageIndex
+
+
+class TestPassageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PassageIndex(capacity=2)
+        for name, vector in [('north', [1, 0, 0]), ('east', [0, 1, 0]), ('north east', [1, 1, 0]), ('up', [0, 0, 1])]:
+            self.index.add(name, vector)
+
+    def test_grows(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.vectors.shape, (4, 3))
+        np.testing.assert_allclose(np.linalg.norm(self.index.vectors, axis=1), 1, rtol=1e-6)
+
+    def test_search(self):
+        results = self.index.search([1, 0.1, 0], 2)
+        self.assertEqual([item for item, _ in results], ['north', 'north east'])
+        self.assertGreater(results[0][1], results[1][1])
+
+    def test_search_in_order_with_exclusions(self):
+        results = self.index.search([1, 0.1, 0], 2, exclude=['north'], in_order=True)
+        self.assertEqual([item for item, _ in results], ['east', 'north east'])
+
+    def test_dissimilar_and_empty(self):
+        self.assertEqual([item for item, _ in self.index.search([0, 0, 1], 3)], ['up'])
+        self.assertEqual(self.index.search([0, 0, 0], 3), [])
+        self.assertEqual(PassageIndex().search([1, 0], 3), [])
@@ -0,0 +1,72 @@
+import unittest
+from rate_limit import TokenBucket, RetryBudget, CircuitBreaker, CircuitOpenError, backoff_delay
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_waits_once_the_burst_is_spent(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, capacity=2, clock=clock, sleep=clock.sleep)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+
+    def test_rate_adapts(self):
+        bucket = TokenBucket(rate=8, min_rate=1)
+        for _ in range(10):
+            bucket.decrease()
+        self.assertEqual(bucket.rate, 1)
+        for _ in range(100):
+            bucket.increase()
+        self.assertEqual(bucket.rate, 8)
+
+
+class TestRetryBudget(unittest.TestCase):
+
+    def test_budget_runs_out(self):
+        budget = RetryBudget(ratio=0.5, min_retries=1)
+        self.assertTrue(budget.try_retry())
+        self.assertFalse(budget.try_retry())
+        budget.record_request()
+        budget.record_request()
+        self.assertTrue(budget.try_retry())
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_and_recovers(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        clock.sleep(10)
+        breaker.before_call()  # the trial call is let through
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.record_failure()
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        clock.sleep(10)
+        breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_delay_is_capped(self):
+        for attempt in range(20):
+            self.assertTrue(0 <= backoff_delay(attempt, base=1, cap=30) <= min(30, 2 ** attempt))
@@ -0,0 +1,54 @@
+import unittest
+from parameterized import parameterized
+from backends import BackendError, RateLimitedError
+from simulation import SimulatedBackend, LATENCY_DISTRIBUTIONS
+import twee_utils as utils
+
+
+class TestSimulatedBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.slept = []
+        self.backend = SimulatedBackend(mean_latency=0.5, seed=0, sleep=self.slept.append)
+
+    def test_completions_are_twee(self):
+        response = self.backend.complete('mock', ['first', 'second'], n=2, stop=utils.END)
+        self.assertEqual([choice['index'] for choice in response['choices']], [0, 1, 2, 3])
+        for choice in response['choices']:
+            passage = ':: title\n' + utils.gen_to_twee_format_3(choice['text'])
+            self.assertTrue(utils.is_valid_passage(passage))
+            self.assertNotIn(utils.END, choice['text'])
+        self.assertEqual(len(self.slept), 1)
+
+    def test_stream(self):
+        backend = SimulatedBackend(latency='constant', mean_latency=0.5, seed=0, sleep=self.slept.append)
+        chunks = list(backend.stream('mock', 'first', stop=utils.END))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(len(self.slept), len(chunks))
+        self.assertAlmostEqual(self.slept[0], 0.1)
+        for slept in self.slept[1:]:
+            self.assertAlmostEqual(slept, 0.4 / (len(chunks) - 1))
+        self.assertAlmostEqual(sum(self.slept), 0.5)
+
+    @parameterized.expand([[name] for name in LATENCY_DISTRIBUTIONS])
+    def test_latency_distributions(self, latency):
+        backend = SimulatedBackend(latency=latency, mean_latency=0.5, seed=0, sleep=self.slept.append)
+        for _ in range(200):
+            backend.complete('mock', 'prompt')
+        self.assertAlmostEqual(sum(self.slept) / len(self.slept), 0.5, delta=0.15)
+
+    def test_injected_errors(self):
+        self.backend.rate_limit_rate = 1
+        self.assertRaises(RateLimitedError, self.backend.complete, 'mock', 'prompt')
+        self.backend.rate_limit_rate, self.backend.timeout_rate = 0, 1
+        self.assertRaises(BackendError, self.backend.complete, 'mock', 'prompt')
+        self.assertEqual(self.slept, [self.backend.timeout])
+        self.assertEqual(self.backend.stats['rate_limited'], 1)
+        self.assertEqual(self.backend.stats['timed_out'], 1)
+
+    def test_malformed_twee(self):
+        self.backend.malformed_rate = 1
+        response = self.backend.complete('mock', ['prompt'] * 20, stop=utils.END)
+        for choice in response['choices']:
+            passage = ':: title\n' + utils.gen_to_twee_format_3(choice['text'])
+            self.assertFalse(utils.is_valid_passage(passage))
@@ -0,0 +1,42 @@
+import threading
+import unittest
+from speculation import Speculator
+
+
+class TestSpeculator(unittest.TestCase):
+
+    def setUp(self):
+        self.generated = []
+        self.speculator = Speculator(self.generate, max_in_flight=2, max_kept=2)
+
+    def tearDown(self):
+        self.speculator.shutdown()
+
+    def generate(self, title, context):
+        self.generated.append(title)
+        return f':: {title}\n{context}'
+
+    def test_take_matching_context(self):
+        self.speculator.speculate('door', 'context')
+        self.assertIsNone(self.speculator.take('door', 'another context'))
+        self.assertEqual(self.speculator.take('door', 'context'), ':: door\ncontext')
+        self.assertIsNone(self.speculator.take('door', 'context'))  # only handed over once
+        self.assertEqual(self.speculator.used, 1)
+
+    def test_budget(self):
+        release = threading.Event()
+        speculator = Speculator(lambda title, context: release.wait(), max_in_flight=1, max_kept=1)
+        speculator.speculate('door', '')
+        speculator.speculate('window', '')  # ignored, door is still generating
+        release.set()
+        self.assertIsNone(speculator.take('window', ''))
+        self.assertTrue(speculator.take('door', ''))
+        speculator.shutdown()
+
+    def test_old_passages_are_thrown_away(self):
+        for title in ['door', 'window', 'stairs']:
+            self.speculator.speculate(title, '')
+            self.speculator._passages[(title, '')].result()
+        self.assertIsNone(self.speculator.take('door', ''))
+        self.assertEqual(self.speculator.wasted, 1)
+        self.assertIsNotNone(self.speculator.take('stairs', ''))
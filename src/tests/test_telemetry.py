@@ -0,0 +1,58 @@
+import json
+import os
+import tempfile
+import unittest
+from telemetry import Histogram, Telemetry, percentile
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_cumulative(self):
+        histogram = Histogram([1, 2, 4])
+        for value in [0.5, 1, 3, 10]:
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative(), [(1, 2), (2, 2), (4, 3), ('+Inf', 4)])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 14.5)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertIsNone(percentile([], 50))
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_records_calls_and_errors(self):
+        telemetry = Telemetry()
+        with telemetry.call('passage', 'model') as call:
+            call['cache'] = 'miss'
+            call['prompt_tokens'] = 10
+            call['retries'] = 2
+        with self.assertRaises(ValueError):
+            with telemetry.call('passage', 'model'):
+                raise ValueError()
+
+        summary = telemetry.summary()['passage']
+        self.assertEqual(summary['calls'], 2)
+        self.assertEqual(summary['errors'], 1)
+        self.assertEqual(summary['cache'], {'hit': 0, 'miss': 1, 'skip': 1})
+        self.assertEqual(summary['prompt_tokens'], 10)
+        self.assertEqual(summary['retries'], 2)
+
+    def test_export(self):
+        telemetry = Telemetry()
+        with telemetry.call('summary', 'model') as call:
+            call['completion_tokens'] = 20
+
+        with tempfile.TemporaryDirectory() as directory:
+            json_path, prometheus_path = os.path.join(directory, 't.json'), os.path.join(directory, 't.prom')
+            telemetry.export(json_path, prometheus_path)
+            with open(json_path) as f:
+                self.assertEqual(json.load(f)['summary']['completion_tokens'], 20)
+            with open(prometheus_path) as f:
+                prometheus = f.read()
+        self.assertIn('# TYPE spindle_completion_latency_seconds histogram', prometheus)
+        self.assertIn('spindle_completion_completion_tokens_bucket{kind="summary",le="32"} 1', prometheus)
+        self.assertIn('spindle_completion_calls_total{kind="summary",cache="skip"} 1', prometheus)
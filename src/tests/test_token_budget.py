@@ -0,0 +1,52 @@
+import unittest
+from collections import OrderedDict
+from unittest import mock
+import token_budget
+from token_budget import TokenBudget, count_tokens, estimate_tokens
+
+
+class TestTokenBudget(unittest.TestCase):
+
+    def setUp(self):
+        events = 'Preceding Events:\n' + ''.join(f'* the knight {i} slay the dragon {i}\n' for i in range(50))
+        self.sections = OrderedDict([
+            ('pronouns', 'Pronouns referenced: she, he, you.'),
+            ('entities', 'Previously mentioned characters: Anna. Prior locations: London.'),
+            ('events', events),
+        ])
+
+    def test_fits_untouched(self):
+        sections, usage = TokenBudget().fit(self.sections, fixed_text='<|begin|>:: start<|start|>')
+        self.assertEqual(sections, self.sections)
+        self.assertEqual(set(usage), {'pronouns', 'entities', 'events', 'fixed'})
+
+    def test_lowest_priority_trimmed_first(self):
+        pronouns_and_entities = count_tokens(self.sections['pronouns']) + count_tokens(self.sections['entities'])
+        budget = TokenBudget(window=pronouns_and_entities + 60, max_tokens=0)
+        sections, usage = budget.fit(self.sections)
+        self.assertEqual(sections['entities'], self.sections['entities'])
+        self.assertEqual(sections['pronouns'], self.sections['pronouns'])
+        # the most recent events are kept
+        self.assertTrue(sections['events'].startswith('Preceding Events:\n'))
+        self.assertIn('the knight 49', sections['events'])
+        self.assertNotIn('the knight 0 ', sections['events'])
+        self.assertLessEqual(sum(usage.values()), budget.window - len(self.sections))
+
+    def test_sections_are_dropped(self):
+        budget = TokenBudget(window=count_tokens(self.sections['entities']) + 3, max_tokens=0)
+        sections, usage = budget.fit(self.sections)
+        self.assertEqual(list(sections), ['entities'])
+        self.assertEqual(usage['events'], 0)
+
+
+class TestCountTokens(unittest.TestCase):
+
+    def test_uses_the_tokenizer(self):
+        tokenizer = mock.Mock()
+        tokenizer.encode = lambda text: list(text)
+        with mock.patch.object(token_budget, '_tokenizer', tokenizer):
+            self.assertEqual(count_tokens('four'), 4)
+
+    def test_estimates_without_the_tokenizer(self):
+        with mock.patch.object(token_budget, '_tokenizer', False):
+            self.assertEqual(count_tokens('You open the door.'), estimate_tokens('You open the door.'))
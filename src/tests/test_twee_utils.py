@@ -1,6 +1,6 @@
 from parameterized import parameterized, parameterized_class # https://github.com/wolever/parameterized
 import unittest
-from ..twee_utils import *
+from twee_utils import *
 
 
 class TestValidTwee(unittest.TestCase):
@@ -257,3 +257,48 @@ class TestTweeParsing(unittest.TestCase):
         )
 
 
+
+
+class TestPassageStream(unittest.TestCase):
+
+    def test_links_found_as_they_complete(self):
+        stream = PassageStream()
+        self.assertEqual(stream.feed(' You see a [[do'), [])
+        self.assertEqual(stream.feed('or|door]]<new'), ['door'])
+        self.assertEqual(stream.readable_twee(), ' You see a [[door|door]]')
+        self.assertEqual(stream.feed('line>[[window]]'), ['window'])
+        self.assertEqual(stream.readable_twee(), ' You see a [[door|door]]\n[[window]]')
+        self.assertFalse(stream.done)
+        stream.feed('<|end|>')
+        self.assertTrue(stream.done)
+
+
+class TestRankCandidates(unittest.TestCase):
+
+    def test_rank_candidates(self):
+        unbalanced = "::lick\nsends jolts up your [[spine]."
+        no_links = "::lick\nsends jolts up your spine."
+        invalid_characters = "::lick\nsends jolts up your [[spine]] @ once."
+        best = "::lick\nsends jolts up your [[spine]]."
+        self.assertEqual(
+            rank_candidates([unbalanced, no_links, invalid_characters, best]),
+            [best, invalid_characters, no_links, unbalanced]
+        )
+
+
+class TestRepairPassage(unittest.TestCase):
+
+    @parameterized.expand([
+        [":: lick\nsends jolts up your [[spine].", ":: lick\nsends jolts up your [[spine]]."],
+        [":: lick\nsends jolts up your [spine]].", ":: lick\nsends jolts up your [[spine]]."],
+        [":: lick\nsends jolts up your [[spine", ":: lick\nsends jolts up your [[spine]]"],
+        [":: lick\nsends jolts <<if $x is 1\n[[spine]]", ":: lick\nsends jolts\n[[spine]]"],
+        ["lick\nsends jolts up your [[spine]]", ":: lick\nsends jolts up your [[spine]]"],
+        [":: lick\nsends jolts ] up your [[spine]]", ":: lick\nsends jolts  up your [[spine]]"],
+    ])
+    def test_repair_passage(self, passage, repaired):
+        self.assertEqual(repair_passage(passage, title='lick'), repaired)
+        self.assertTrue(is_valid_passage(repaired))
+
+    def test_valid_passages_are_not_repaired(self):
+        self.assertIsNone(repair_passage(":: lick\nsends jolts up your [[spine]]."))
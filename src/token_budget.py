@@ -0,0 +1,111 @@
+import math
+import re
+import threading
+from collections import OrderedDict
+from narrative_reader import MODEL_CACHE_DIR
+
+# The context window of the original GPT-3 models (curie, davinci), prompt and completion together
+MODEL_WINDOW = 2049
+# The GPT-3 models use the GPT-2 byte pair encoding, so its tokenizer counts their tokens exactly. It is downloaded to
+# MODEL_CACHE_DIR once, then loaded from there.
+TOKENIZER = 'gpt2'
+# If the tokenizer can't be loaded (eg transformers isn't installed, or it can't be downloaded), tokens are estimated
+# from words and punctuation, which slightly undercounts long and rare words
+ESTIMATE_MARGIN = 1.15
+
+# Which context sections to keep the longest when a prompt doesn't fit. Lower priorities are trimmed first.
+DEFAULT_PRIORITIES = {
+    'entities': 3,
+    'summary': 2,
+    'pronouns': 2,
+    'events': 1,
+}
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """
+    Return the GPT-2 tokenizer, loading it the first time it's needed (transformers is slow to import),
+    or None if it can't be loaded.
+    """
+    global _tokenizer
+    if _tokenizer is not None:
+        return _tokenizer if _tokenizer is not False else None
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            try:
+                from transformers import GPT2TokenizerFast
+                tokenizer = GPT2TokenizerFast.from_pretrained(TOKENIZER, cache_dir=MODEL_CACHE_DIR)
+                # Counting long texts is fine, only the model has a maximum length
+                tokenizer.model_max_length = math.inf
+                _tokenizer = tokenizer
+            except Exception as e:
+                print(f"Couldn't load the {TOKENIZER} tokenizer ({e}), estimating token counts instead.")
+                _tokenizer = False
+    return _tokenizer if _tokenizer is not False else None
+
+
+def count_tokens(text):
+    """
+    Count the tokens in text, exactly with the GPT-2 tokenizer if it can be loaded, otherwise estimated.
+    """
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text))
+    return estimate_tokens(text)
+
+
+def estimate_tokens(text):
+    return math.ceil(len(re.findall(r'\w+|[^\w\s]', text)) * ESTIMATE_MARGIN)
+
+
+class TokenBudget:
+    def __init__(self, window=MODEL_WINDOW, max_tokens=1000, priorities=None):
+        """
+        Keep prompts small enough that the prompt plus the completion fit in the model's context window.
+
+        :param window: the model's context window in tokens
+        :param max_tokens: how many tokens are reserved for the completion
+        :param priorities: map from section name to priority, see DEFAULT_PRIORITIES
+        """
+        self.window = window
+        self.max_tokens = max_tokens
+        self.priorities = priorities if priorities else DEFAULT_PRIORITIES
+        self.last_usage = {}
+
+    def __str__(self):
+        return f'<TokenBudget {self.window - self.max_tokens} prompt tokens>'
+
+    def fit(self, sections, fixed_text=''):
+        """
+        Trim context sections, lowest priority first, until they fit in the budget alongside fixed_text.
+        A section is trimmed a line at a time from its oldest (first) item, keeping its first line as a heading,
+        then dropped entirely.
+
+        :param sections: an ordered dict mapping section name -> text, in the order they appear in the prompt
+        :param fixed_text: the rest of the prompt, which can't be trimmed (the title, special tokens...)
+        :return: (the trimmed sections, a dict mapping each section name and 'fixed' to the tokens it uses)
+        """
+        sections = OrderedDict(sections)
+        usage = OrderedDict((name, count_tokens(text)) for name, text in sections.items())
+        usage['fixed'] = count_tokens(fixed_text)
+        # Sections are joined with a space, which may cost a token each
+        available = self.window - self.max_tokens - len(sections)
+
+        by_priority = sorted(sections, key=lambda name: self.priorities.get(name, 0))
+        for name in by_priority:
+            if sum(usage.values()) <= available:
+                break
+            lines = sections[name].split('\n')
+            while len(lines) > 2 and sum(usage.values()) > available:
+                del lines[1]
+                sections[name] = '\n'.join(lines)
+                usage[name] = count_tokens(sections[name])
+            if sum(usage.values()) > available:
+                del sections[name]
+                usage[name] = 0
+
+        self.last_usage = usage
+        return sections, usage
@@ -6,6 +6,7 @@ import zipfile
 import shutil
 import random
 import strbalance
+from collections import Counter
 
 num_re = r'\[([0-9]+.?END[0-9]*)\]'
 
@@ -48,6 +49,11 @@ SPECIAL_PASSAGES = [
 
 balancer = strbalance.Balance(pairs=balance_pairs, custom=True)
 
+# How many invalid passages repair_passage was asked to fix, how many it fixed, and which repairs it made
+REPAIR_STATS = Counter()
+# Links cut off longer than this are dropped rather than closed
+MAX_REPAIRED_LINK_LENGTH = 60
+
 
 def display_untweeability(dir):
 	"""
@@ -93,7 +99,13 @@ def get_links(passage):
 
 	[[A Linked Passage]] -> A Linked Passage
 	"""
+	return find_links(passage)
+
 
+def find_links(passage):
+	"""
+	The uncached version of get_links, for text that is only looked at once (eg partial, streamed passages).
+	"""
 	links = re.findall(r'\[\[(.*?)]]', passage)
 	links = [link for link in links]
 	links = [(l.split('|')[-1] if '|' in l else l) for l in links]
@@ -262,6 +274,105 @@ def is_valid_passage(passage):
 	return all(valid_passage_indicators(passage).values())
 
 
+def candidate_indicators(passage):
+	"""
+	What makes one generated passage better than another, on top of being valid.
+	"""
+	indicators = valid_passage_indicators(passage)
+	indicators['has_links'] = bool(find_links(passage))
+	indicators['valid_characters'] = not any(c in INVALID_PASSAGE_CHARACTERS for c in passage)
+	return indicators
+
+
+def rank_candidates(passages):
+	"""
+	Order candidate passages from best to worst: valid passages first, then those with outgoing links,
+	then those without invalid characters. Passages that are equally good keep their order.
+	"""
+	def badness(passage):
+		indicators = candidate_indicators(passage)
+		valid = indicators['valid_prefix'] and indicators['balanced']
+		return not valid, not indicators['has_links'], not indicators['valid_characters']
+
+	return sorted(passages, key=badness)
+
+
+def repair_passage(passage, title=None):
+	"""
+	Fix the common ways a generated passage fails is_valid_passage, so that it doesn't have to be generated again:
+		- a title line without the :: prefix
+		- a link missing one of its brackets: [[link] or [link]]
+		- a link cut off at the end of a line: [[link
+		- a macro that is never closed: <<if $x
+		- stray brackets
+
+	Links and macros don't span lines, so brackets are balanced one line at a time.
+
+	:param title: the passage's title, used if the title line is missing
+	:return: the repaired passage, or None if it couldn't be repaired. REPAIR_STATS counts the outcome and repairs.
+	"""
+	REPAIR_STATS['attempted'] += 1
+	lines = list(split_lines(passage.strip()))
+	repairs = []
+
+	if not lines[0].startswith('::'):
+		if lines[0].startswith(':') or (title is not None and lines[0].strip().lower() == title.strip().lower()):
+			lines[0] = make_title(lines[0].lstrip(': '), process=False)
+		elif title is not None:
+			lines.insert(0, make_title(title, process=False))
+		repairs.append('title')
+
+	lines[1:] = [_repair_line(line, repairs) for line in lines[1:]]
+	repaired = unsplit_lines(lines)
+
+	if not repairs or not is_valid_passage(repaired):
+		REPAIR_STATS['failed'] += 1
+		return None
+	REPAIR_STATS['repaired'] += 1
+	REPAIR_STATS.update(repairs)
+	return repaired
+
+
+def _repair_line(line, repairs):
+	"""
+	Balance the links, macros and brackets in a line of a passage, adding the name of each repair made to repairs.
+	"""
+	# [[link] or [link]] -> [[link]]
+	line, fixed = re.subn(r'(?<!\[)\[\[([^\[\]]+)](?!])', r'[[\1]]', line)
+	line, fixed_too = re.subn(r'(?<!\[)\[([^\[\]]+)]](?!])', r'[[\1]]', line)
+	if fixed or fixed_too:
+		repairs.append('link_bracket')
+
+	# A link that was cut off is closed if there's enough of it left, otherwise dropped
+	truncated = re.search(r'\[\[([^\]]*)$', line)
+	if truncated:
+		link = truncated.group(1).split('|')[-1].strip()
+		if link and len(link) <= MAX_REPAIRED_LINK_LENGTH and '<' not in link:
+			line = line.rstrip() + ']]'
+		else:
+			line = line[:truncated.start()].rstrip()
+		repairs.append('truncated_link')
+
+	# Whatever is still unmatched: unclosed macros are dropped to the end of the line, stray brackets removed
+	stack, unmatched = [], []
+	for match in re.finditer(r'<<|>>|\[|]', line):
+		token = match.group()
+		if token in ('<<', '['):
+			stack.append(match)
+		elif stack and stack[-1].group() == {'>>': '<<', ']': '['}[token]:
+			stack.pop()
+		else:
+			unmatched.append(match)
+	for match in sorted(unmatched + stack, key=lambda m: m.start(), reverse=True):
+		if match.group() == '<<':
+			line = line[:match.start()].rstrip()
+			repairs.append('dangling_macro')
+		elif match.start() < len(line):
+			line = line[:match.start()] + line[match.end():]
+			repairs.append('stray_bracket')
+	return line
+
+
 def contains_start(passages):
 	return any([is_start(p) for p in passages])
 
@@ -494,6 +605,46 @@ def gen_to_twee_format_3(prompt='', response=''):
 	return twee
 
 
+class PassageStream:
+	"""
+	Accumulate a generated completion as it streams in, so it can be shown and its links extracted before it is done.
+	"""
+
+	def __init__(self):
+		self.text = ''
+		self.links = []
+
+	def feed(self, chunk):
+		"""
+		Add the next chunk of generated text.
+
+		:return: the links completed by this chunk
+		"""
+		self.text += chunk
+		new_links = [link for link in find_links(self.readable_gen()) if link not in self.links]
+		self.links += new_links
+		return new_links
+
+	def readable_gen(self):
+		"""
+		The generated text so far, minus a trailing special token (eg a <newline>) that hasn't fully arrived yet.
+		"""
+		partial = self.text.rfind('<')
+		if partial != -1 and '>' not in self.text[partial:]:
+			return self.text[:partial]
+		return self.text
+
+	def readable_twee(self):
+		"""
+		The twee received so far, safe to display.
+		"""
+		return gen_to_twee_format_3(response=self.readable_gen())
+
+	@property
+	def done(self):
+		return END in self.text
+
+
 def gen_to_twee_format(gen):
 	"""
 	Change from the generated format back to twee